@@ -0,0 +1,73 @@
+import os
+import numpy as np
+
+# Generate a tileable 3D blue noise threshold mask using the void-and-cluster method (Ulichney 1993)
+# The mask is precomputed and stored with the dithering functions, run this file to regenerate it
+
+MASK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blue_noise_16.npy')
+
+def gaussianEnergy(size, sigma):
+    # Toroidal gaussian kernel centered on voxel (0, 0, 0)
+    d = np.minimum(np.arange(size), size - np.arange(size)).astype(np.float64)
+    d2 = d[:, None, None] ** 2 + d[None, :, None] ** 2 + d[None, None, :] ** 2
+    return np.exp(-d2 / (2 * sigma ** 2))
+
+def voidAndCluster(size=16, sigma=1.5, initial_density=0.1, seed=0):
+    n = size ** 3
+    kernel = gaussianEnergy(size, sigma)
+    kernel_fft = np.fft.rfftn(kernel)
+    rng = np.random.default_rng(seed)
+
+    def energy(pattern):
+        return np.fft.irfftn(np.fft.rfftn(pattern) * kernel_fft, s=pattern.shape, axes=(0, 1, 2))
+
+    def splat(e, index, sign):
+        # Add or remove the energy contribution of a single point
+        coords = np.unravel_index(index, (size, size, size))
+        e += sign * np.roll(kernel, coords, axis=(0, 1, 2))
+
+    # Initial pattern: random points, relaxed by moving the tightest cluster into the largest void
+    pattern = (rng.random((size, size, size)) < initial_density).astype(np.float64)
+    e = energy(pattern)
+    while True:
+        cluster = np.argmax(np.where(pattern > 0, e, -np.inf))
+        pattern.flat[cluster] = 0
+        splat(e, cluster, -1)
+
+        void = np.argmin(np.where(pattern > 0, np.inf, e))
+        if void == cluster:
+            pattern.flat[cluster] = 1
+            splat(e, cluster, 1)
+            break
+
+        pattern.flat[void] = 1
+        splat(e, void, 1)
+
+    ranks = np.zeros(n, dtype=np.int32)
+    ones = int(pattern.sum())
+
+    # Phase 1: rank the initial points by repeatedly removing the tightest cluster
+    p = pattern.copy()
+    pe = e.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = np.argmax(np.where(p > 0, pe, -np.inf))
+        p.flat[cluster] = 0
+        splat(pe, cluster, -1)
+        ranks[cluster] = rank
+
+    # Phase 2: fill the remaining voxels by repeatedly filling the largest void
+    for rank in range(ones, n):
+        void = np.argmin(np.where(pattern > 0, np.inf, e))
+        pattern.flat[void] = 1
+        splat(e, void, 1)
+        ranks[void] = rank
+
+    return ranks.reshape((size, size, size))
+
+def loadBlueNoise():
+    return np.load(MASK_FILE)
+
+if __name__ == '__main__':
+    mask = voidAndCluster()
+    np.save(MASK_FILE, mask.astype(np.uint16))
+    print('Saved ' + MASK_FILE)
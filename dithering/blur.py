@@ -0,0 +1,158 @@
+import functools
+
+import numpy as np
+from scipy import ndimage
+from scipy import fft
+
+from voxelfuse.voxel_model import VoxelModel
+
+from dithering.indexing import internMaterials, reindexMaterials
+
+# Gaussian blur of material mixtures, equivalent to VoxelModel.blur
+# Only channels that contain material are filtered, one axis at a time, in float32
+# Large radii are convolved with FFTs, the kernel spectra are cached so models of the same size share them
+#
+# Blur for transitions that only vary along one axis
+# The material fractions of each slice are blurred as a 1D profile and broadcast back over the occupied voxels
+# For a model with the same occupancy in every slice, one material per slice and full density this is equivalent
+# up to float rounding: the 3D blur of f(x) * mask(y, z) is blur(f)(x) * blur(mask)(y, z), and the second factor
+# cancels in scaleValues
+
+TRUNCATE = 4.0          # kernel half width in standard deviations, as in ndimage.gaussian_filter
+FFT_RADIUS = 24         # blur radius (voxels) above which the 1D passes use FFT convolution
+CHUNK_SIZE = 2 ** 22    # max voxels filtered at once
+
+def gaussianKernel(sigma):
+    # Same weights as ndimage.gaussian_filter1d
+    half_width = int(TRUNCATE * sigma + 0.5)
+    x = np.arange(-half_width, half_width + 1)
+    kernel = np.exp(-0.5 / sigma ** 2 * x ** 2)
+    return kernel / kernel.sum()
+
+@functools.lru_cache(maxsize=32)
+def kernelSpectrum(n_fft, sigma):
+    return fft.rfft(gaussianKernel(sigma), n_fft).astype(np.complex64)
+
+def fftFilter1d(data, sigma, axis):
+    # Linear convolution of the padded data, mode='reflect' padding as in ndimage
+    half_width = int(TRUNCATE * sigma + 0.5)
+    length = data.shape[axis]
+    padding = [(0, 0)] * data.ndim
+    padding[axis] = (half_width, half_width)
+    padded = np.pad(data, padding, mode='symmetric')
+
+    n_fft = fft.next_fast_len(padded.shape[axis], real=True)
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    spectrum = fft.rfft(padded, n_fft, axis=axis)
+    spectrum *= kernelSpectrum(n_fft, sigma).reshape(shape)
+    result = fft.irfft(spectrum, n_fft, axis=axis)
+
+    index = [slice(None)] * data.ndim
+    index[axis] = slice(2 * half_width, 2 * half_width + length)
+    return result[tuple(index)].astype(np.float32)
+
+def filter1d(data, sigma, axis):
+    if 2 * sigma > FFT_RADIUS:
+        return fftFilter1d(data, sigma, axis)
+    return ndimage.gaussian_filter1d(data, sigma, axis=axis, truncate=TRUNCATE)
+
+def blurChannel(channel, sigma):
+    # Filter along each axis in turn, in slabs along the longest other axis (lines along the filtered axis are independent)
+    for axis in range(channel.ndim):
+        others = [a for a in range(channel.ndim) if a != axis]
+        chunk_axis = max(others, key=lambda a: channel.shape[a])
+        step = max(1, CHUNK_SIZE // max(1, channel.size // channel.shape[chunk_axis]))
+        for start in range(0, channel.shape[chunk_axis], step):
+            index = [slice(None)] * channel.ndim
+            index[chunk_axis] = slice(start, start + step)
+            index = tuple(index)
+            channel[index] = filter1d(channel[index], sigma, axis)
+    return channel
+
+def blurModel(model, radius, scale=False):
+    # Same as model.blur(radius), or model.blur(radius).scaleValues() with scale
+    if radius == 0:
+        return model.scaleValues() if scale else VoxelModel.copy(model)
+
+    materials = np.asarray(model.materials, dtype=np.float32)
+    used = np.unique(model.voxels)
+    active = [c for c in range(1, materials.shape[1]) if (materials[used, c] != 0).any()]
+
+    # Full material array of the occupancy and the active channels only
+    occupancy = materials[:, 0][model.voxels]
+    full = np.empty(model.voxels.shape + (len(active) + 1,), dtype=np.float32)
+    full[..., 0] = occupancy * occupancy
+    for i, c in enumerate(active):
+        full[..., i + 1] = blurChannel(materials[:, c][model.voxels], radius / 2) * occupancy
+
+    voxels, active_materials = internMaterials(full)
+    new_materials = np.zeros((len(active_materials), materials.shape[1]), dtype=np.float32)
+    new_materials[:, [0] + active] = active_materials
+    new_model = VoxelModel(voxels, new_materials, model.coords, model.resolution)
+
+    # scaleValues only needs the palette
+    return new_model.scaleValues() if scale else new_model
+
+def sliceIndex(model, axis=0):
+    # Slice number of each voxel along axis
+    shape = [1, 1, 1]
+    shape[axis] = model.voxels.shape[axis]
+    return np.broadcast_to(np.arange(model.voxels.shape[axis]).reshape(shape), model.voxels.shape)
+
+def isAxisAligned(model, axis=0):
+    # True if every slice along axis has the same occupancy and a single material, and every occupied voxel has full density
+    # (the 3D blur keeps the density of each voxel, squared, the 1D blur sets it to 1)
+    voxels = np.moveaxis(model.voxels, axis, 0)
+    occupied = (model.materials[:, 0] > 0)[voxels]
+    if not (occupied == occupied[:1]).all():
+        return False
+    used = np.unique(voxels)
+    used = used[model.materials[used, 0] > 0]
+    if not (model.materials[used, 0] == 1).all():
+        return False
+    index = voxels[:, occupied[0]]
+    return bool((index == index[:, :1]).all())
+
+def sliceProfile(model, axis=0):
+    # Total material fractions (columns 1..n) of the occupied voxels in each slice along axis
+    materials = np.asarray(model.materials, dtype=np.float32)
+    n_palette = len(materials)
+    x_len = model.voxels.shape[axis]
+
+    keys = sliceIndex(model, axis) * n_palette + model.voxels
+    counts = np.bincount(keys.ravel(), minlength=x_len * n_palette).reshape(x_len, n_palette).astype(np.float64)
+    counts[:, materials[:, 0] <= 0] = 0
+    return (counts @ materials[:, 1:]).astype(np.float32)
+
+def axisBlur(model, radius, axis=0, exact=True):
+    # Same as model.blur(radius).scaleValues() (up to float rounding) for a model that only varies along axis
+    # With exact, returns None if the model does not (see isAxisAligned) so the caller can fall back to the 3D blur
+    # Otherwise, slices with varying occupancy or mixed materials are approximated by their total material fractions
+    # (slices with more material have more weight, as in the 3D blur), and every occupied voxel gets full density
+    if exact and not isAxisAligned(model, axis):
+        return None
+
+    profile = sliceProfile(model, axis)
+    if radius > 0:
+        profile = ndimage.gaussian_filter1d(profile, sigma=radius/2, axis=0)
+
+    # scaleValues
+    sums = profile.sum(axis=1)
+    sums[sums == 0] = 1
+    profile = profile / sums[:, None]
+
+    # One palette entry per slice, broadcast over the occupied voxels
+    palette = np.vstack((np.zeros((1, profile.shape[1] + 1), dtype=np.float32), np.hstack((np.ones((len(profile), 1), dtype=np.float32), profile))))
+    occupied = (model.materials[:, 0] > 0)[model.voxels]
+    voxels = np.where(occupied, sliceIndex(model, axis) + 1, 0)
+
+    voxels, materials = reindexMaterials(voxels, palette)
+    return VoxelModel(voxels, materials, model.coords, model.resolution)
+
+def blurScaled(model, radius, axis=None, exact=True):
+    # model.blur(radius).scaleValues(), blurred in 1D when the model only varies along axis (None to always blur in 3D)
+    result = axisBlur(model, radius, axis, exact) if axis is not None else None
+    if result is None:
+        result = blurModel(model, radius, scale=True)
+    return result
@@ -12,7 +12,14 @@ from voxelfuse.plot import Plot
 from voxelfuse.primitives import cuboid
 from voxelfuse.voxel_model import VoxelModel
 
-from numba import njit
+from numba import njit, prange
+
+from scipy import ndimage
+
+from dithering.blue_noise import loadBlueNoise
+from dithering.blur import blurModel
+from dithering.indexing import internMaterials, reindexMaterials
+from profiling.tracing import span
 
 @njit()
 def toFullMaterials(voxels, materials, n_materials):
@@ -30,82 +37,525 @@ def toFullMaterials(voxels, materials, n_materials):
 
     return full_model
 
-def toIndexedMaterials(voxels, model):
-    x_len = model.voxels.shape[0]
-    y_len = model.voxels.shape[1]
-    z_len = model.voxels.shape[2]
+def toIndexedMaterials(voxels, model, channels=None):
+    new_voxels, new_materials = internMaterials(voxels)
 
-    new_voxels = np.zeros((x_len, y_len, z_len), dtype=np.int32)
-    new_materials = np.zeros((1, len(material_properties) + 1), dtype=np.float32)
+    if channels is not None:
+        new_materials = expandChannels(new_materials, channels, len(material_properties) + 1)
 
-    for x in range(x_len):
-        for y in range(y_len):
-            for z in range(z_len):
-                m = voxels[x, y, z, :]
-                i = np.where(np.equal(new_materials, m).all(1))[0]
+    return VoxelModel(new_voxels, new_materials, model.coords, model.resolution)
 
-                if len(i) > 0:
-                    new_voxels[x, y, z] = i[0]
-                else:
-                    new_materials = np.vstack((new_materials, m))
-                    new_voxels[x, y, z] = len(new_materials) - 1
+def activeChannels(materials, error_spread_threshold=0.8):
+    # Density channel plus every material channel used by at least one palette entry
+    used = np.flatnonzero(np.any(materials[:, 1:] != 0, axis=0)) + 1
+    unused = np.setdiff1d(np.arange(1, materials.shape[1]), used)
+
+    # An unused channel is always 0. It only affects dithering if a zero value can exceed the
+    # error spread threshold (locking every voxel), or if no material channels are in use at all.
+    if len(unused) > 0 and (error_spread_threshold < 0 or len(used) == 0):
+        used = np.sort(np.append(used, unused[0]))
+
+    return np.concatenate(([0], used))
 
-    return VoxelModel(new_voxels, new_materials, model.coords)
+def expandChannels(materials, channels, n_materials):
+    full_materials = np.zeros((len(materials), n_materials), dtype=np.float32)
+    full_materials[:, channels] = materials
+    return full_materials
 
 @njit()
 def addError(model, error, constant, i, x, y, z, x_len, y_len, z_len, error_spread_threshold):
-    if y < y_len and x < x_len and z < z_len:
+    # Zero weights are skipped so that independent slices never write to each other
+    if constant != 0 and y < y_len and x < x_len and z < z_len:
         high = np.where(model[x, y, z, 1:] > error_spread_threshold)[0]
         if len(high) == 0:
             model[x, y, z, i] += error * constant * model[x, y, z, 0]
 
+@njit()
+def ditherPlane(full_model, z, z_len, use_full, x_error, y_error, z_error, error_spread_threshold):
+    # Dither a single z plane
+    ditherBlock(full_model, 0, full_model.shape[0], 0, full_model.shape[1], z, z_len, use_full, x_error, y_error, z_error, error_spread_threshold)
+
+@njit()
+def ditherBlock(full_model, x_start, x_end, y_start, y_end, z, z_len, use_full, x_error, y_error, z_error, error_spread_threshold):
+    x_len = full_model.shape[0]
+    y_len = full_model.shape[1]
+
+    for y in range(y_start, y_end):
+        for x in range(x_start, x_end):
+            voxel = full_model[x, y, z]
+            if voxel[0] == 1.0:
+                max_i = voxel[1:].argmax()+1
+                for i in range(1, len(voxel)):
+                    if full_model[x, y, z, i] != 0:
+                        old = full_model[x, y, z, i]
+
+                        if i == max_i:
+                            full_model[x, y, z, i] = 1
+                        else:
+                            full_model[x, y, z, i] = 0
+
+                        error = old - full_model[x, y, z, i]
+
+                        if use_full:
+                            # Based on Fundamentals of 3D Halftoning by Lou and Stucki
+                            addError(full_model, error, 4/21, i, x+1, y, z, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, 1/21, i, x+2, y, z, x_len, y_len, z_len, error_spread_threshold)
+
+                            addError(full_model, error, 4/21, i, x, y+1, z, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, 1/21, i, x, y+2, z, x_len, y_len, z_len, error_spread_threshold)
+
+                            addError(full_model, error, 1/21, i, x+1, y+1, z, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, 1/21, i, x-1, y+1, z, x_len, y_len, z_len, error_spread_threshold)
+
+                            addError(full_model, error, 1/21, i, x, y-1, z+1, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, 1/21, i, x-1, y, z+1, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, 1/21, i, x, y+1, z+1, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, 1/21, i, x+1, y, z+1, x_len, y_len, z_len, error_spread_threshold)
+
+                            addError(full_model, error, 4/21, i, x, y, z+1, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, 1/21, i, x, y, z+2, x_len, y_len, z_len, error_spread_threshold)
+                        else:
+                            addError(full_model, error, x_error, i, x+1, y, z, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, y_error, i, x, y+1, z, x_len, y_len, z_len, error_spread_threshold)
+                            addError(full_model, error, z_error, i, x, y, z+1, x_len, y_len, z_len, error_spread_threshold)
+
 @njit()
 def ditherOptimized(full_model, use_full, x_error, y_error, z_error, error_spread_threshold):
+    z_len = full_model.shape[2]
+
+    for z in range(z_len):
+        ditherPlane(full_model, z, z_len, use_full, x_error, y_error, z_error, error_spread_threshold)
+
+    return full_model
+
+@njit(parallel=True, cache=True)
+def ditherSlices(full_model, x_error, y_error, error_spread_threshold):
+    # With no error spread in z, every z plane is independent. If error is also only spread along
+    # one of x or y, every line along that axis is independent.
+    x_len = full_model.shape[0]
+    y_len = full_model.shape[1]
+    z_len = full_model.shape[2]
+
+    x_lines = x_len if x_error == 0 else 1
+    y_lines = y_len if (y_error == 0 and x_error != 0) else 1
+
+    for s in prange(z_len * x_lines * y_lines):
+        z = s // (x_lines * y_lines)
+        x_start, x_end = 0, x_len
+        y_start, y_end = 0, y_len
+
+        if x_lines > 1:
+            x_start = s % x_lines
+            x_end = x_start + 1
+        if y_lines > 1:
+            y_start = s % y_lines
+            y_end = y_start + 1
+
+        ditherBlock(full_model, x_start, x_end, y_start, y_end, z, z_len, False, x_error, y_error, 0.0, error_spread_threshold)
+
+    return full_model
+
+# Error diffusion stencils, as (dx, dy, dz, weight) in the order error is spread
+STENCILS = {
+    # Based on Fundamentals of 3D Halftoning by Lou and Stucki
+    'lou_stucki': [(1, 0, 0, 4/21), (2, 0, 0, 1/21), (0, 1, 0, 4/21), (0, 2, 0, 1/21), (1, 1, 0, 1/21), (-1, 1, 0, 1/21),
+                   (0, -1, 1, 1/21), (-1, 0, 1, 1/21), (0, 1, 1, 1/21), (1, 0, 1, 1/21), (0, 0, 1, 4/21), (0, 0, 2, 1/21)],
+    # Floyd-Steinberg, applied to each z plane separately
+    'floyd_steinberg': [(1, 0, 0, 7/16), (-1, 1, 0, 3/16), (0, 1, 0, 5/16), (1, 1, 0, 1/16)],
+}
+
+def stencilArrays(stencil):
+    # Convert a stencil name or list of (dx, dy, dz, weight) to offset and weight arrays
+    if isinstance(stencil, str):
+        stencil = STENCILS[stencil]
+
+    stencil = np.array(stencil, dtype=np.float64).reshape(-1, 4)
+    offsets = stencil[:, :3].astype(np.int64)
+    weights = np.ascontiguousarray(stencil[:, 3])
+
+    for dx, dy, dz in offsets:
+        if dz < 0 or (dz == 0 and (dy < 0 or (dy == 0 and dx <= 0))):
+            raise ValueError('Error diffusion stencil must only spread error to unprocessed voxels')
+
+    return offsets, weights
+
+def ditherStencil(use_full, x_error, y_error, z_error):
+    # Stencil equivalent to the use_full and x/y/z_error settings
+    if use_full:
+        return stencilArrays('lou_stucki')
+    else:
+        return stencilArrays([(1, 0, 0, x_error), (0, 1, 0, y_error), (0, 0, 1, z_error)])
+
+def wavefrontLag(offsets):
+    # Row (y, z) is processed at step y + lag*z. The lag must put every row that spreads error to
+    # the current row at an earlier step.
+    lag = 1
+    for dx, dy, dz in offsets:
+        if dz > 0:
+            lag = max(lag, -((dy - 1) // dz))
+    return lag
+
+@njit(cache=True)
+def lockVoxels(full_model, locked, z, error_spread_threshold):
+    # Voxels with a material channel above the threshold do not receive error
+    zi = z % full_model.shape[2]
+    for y in range(full_model.shape[1]):
+        for x in range(full_model.shape[0]):
+            locked[x, y, zi] = False
+            for i in range(1, full_model.shape[3]):
+                if full_model[x, y, zi, i] > error_spread_threshold:
+                    locked[x, y, zi] = True
+
+@njit(cache=True)
+def diffusePlane(full_model, locked, z, z_len, offsets, weights, error_spread_threshold):
+    # Dither plane z using an error diffusion stencil. full_model and locked may hold all planes,
+    # or a ring buffer of the planes that can receive error from plane z.
     x_len = full_model.shape[0]
     y_len = full_model.shape[1]
+    depth = full_model.shape[2]
+    zi = z % depth
+
+    for y in range(y_len):
+        for x in range(x_len):
+            if full_model[x, y, zi, 0] == 1.0:
+                max_i = full_model[x, y, zi, 1:].argmax() + 1
+                for i in range(1, full_model.shape[3]):
+                    if full_model[x, y, zi, i] != 0:
+                        old = full_model[x, y, zi, i]
+
+                        if i == max_i:
+                            full_model[x, y, zi, i] = 1
+                        else:
+                            full_model[x, y, zi, i] = 0
+
+                        error = old - full_model[x, y, zi, i]
+
+                        for k in range(len(weights)):
+                            tx = x + offsets[k, 0]
+                            ty = y + offsets[k, 1]
+                            tz = z + offsets[k, 2]
+
+                            # Targets are only bounds-checked on the high side, offsets below 0 wrap around once (as in addError)
+                            if tx < 0:
+                                tx += x_len
+                            if ty < 0:
+                                ty += y_len
+
+                            if weights[k] != 0 and 0 <= tx < x_len and 0 <= ty < y_len and tz < z_len:
+                                tz = tz % depth
+                                if not locked[tx, ty, tz]:
+                                    full_model[tx, ty, tz, i] += error * weights[k] * full_model[tx, ty, tz, 0]
+
+                                    # Only channel i changed, so the voxel is locked if channel i crossed the threshold
+                                    if full_model[tx, ty, tz, i] > error_spread_threshold:
+                                        locked[tx, ty, tz] = True
+
+@njit(cache=True)
+def ditherDiffusion(full_model, offsets, weights, error_spread_threshold):
     z_len = full_model.shape[2]
+    locked = np.zeros(full_model.shape[:3], dtype=np.bool_)
 
     for z in range(z_len):
+        lockVoxels(full_model, locked, z, error_spread_threshold)
+
+    for z in range(z_len):
+        diffusePlane(full_model, locked, z, z_len, offsets, weights, error_spread_threshold)
+
+    return full_model
+
+@njit()
+def addSourceError(full_model, locked, max_index, weights, stencil_ids, start, end, sx, sy, sz, x, y, z, error_spread_threshold):
+    # Apply the error spread from source voxel (sx, sy, sz) to (x, y, z) by stencil entries start..end
+    max_i = max_index[sx, sy, sz]
+    if max_i > 0:
+        for i in range(1, full_model.shape[3]):
+            old = full_model[sx, sy, sz, i]
+            if old != 0:
+                if i == max_i:
+                    error = old - np.float32(1)
+                else:
+                    error = old - np.float32(0)
+
+                for c in range(start, end):
+                    if not locked[x, y, z]:
+                        full_model[x, y, z, i] += error * weights[stencil_ids[c]] * full_model[x, y, z, 0]
+                        if full_model[x, y, z, i] > error_spread_threshold:
+                            locked[x, y, z] = True
+
+@njit()
+def gatherError(full_model, locked, max_index, offsets, weights, rows, keys, stencil_ids, x, y, z, error_spread_threshold):
+    # Apply the error that serial dithering would spread to (x, y, z) from other rows, in the same order
+    # Only needed near the high x and y edges, where offsets that step below 0 wrap around to the far side of the model
+    x_len = full_model.shape[0]
+    y_len = full_model.shape[1]
+    z_len = full_model.shape[2]
+    lengths = (x_len, y_len, z_len)
+    target = (x, y, z)
+
+    # Find source voxels
+    n = 0
+    for k in rows:
+        if weights[k] == 0:
+            continue
+        for wrap in range(8):
+            valid = True
+            source = [0, 0, 0]
+            for a in range(3):
+                s = target[a] - offsets[k, a]
+                if (wrap >> a) & 1:
+                    s -= lengths[a]
+                if s < 0 or s >= lengths[a]:
+                    valid = False
+                source[a] = s
+            if valid:
+                keys[n] = ((((source[2] * y_len) + source[1]) * x_len + source[0]) * len(weights)) + k
+                stencil_ids[n] = k
+                n += 1
+
+    # Sort sources into the order they were processed
+    for a in range(1, n):
+        key = keys[a]
+        k = stencil_ids[a]
+        b = a - 1
+        while b >= 0 and keys[b] > key:
+            keys[b + 1] = keys[b]
+            stencil_ids[b + 1] = stencil_ids[b]
+            b -= 1
+        keys[b + 1] = key
+        stencil_ids[b + 1] = k
+
+    start = 0
+    while start < n:
+        end = start + 1
+        while end < n and keys[end] // len(weights) == keys[start] // len(weights):
+            end += 1
+
+        source = keys[start] // len(weights)
+        addSourceError(full_model, locked, max_index, weights, stencil_ids, start, end,
+                       source % x_len, (source // x_len) % y_len, source // (x_len * y_len), x, y, z, error_spread_threshold)
+        start = end
+
+@njit()
+def ditherRow(full_model, locked, max_index, offsets, weights, rows, edge_x, edge_y, in_row, keys, stencil_ids, y, z, error_spread_threshold):
+    # Collect the error from earlier rows, then dither the row and push error along it as in diffusePlane
+    x_len = full_model.shape[0]
+    y_len = full_model.shape[1]
+    z_len = full_model.shape[2]
+
+    # rows is sorted so that, away from the edges, sources are visited in the order they were processed
+    for x in range(x_len):
+        if x >= edge_x or y >= edge_y:
+            gatherError(full_model, locked, max_index, offsets, weights, rows, keys, stencil_ids, x, y, z, error_spread_threshold)
+        else:
+            for k in rows:
+                sx = x - offsets[k, 0]
+                sy = y - offsets[k, 1]
+                sz = z - offsets[k, 2]
+                if weights[k] != 0 and 0 <= sx < x_len and 0 <= sy < y_len and 0 <= sz < z_len:
+                    stencil_ids[0] = k
+                    addSourceError(full_model, locked, max_index, weights, stencil_ids, 0, 1, sx, sy, sz, x, y, z, error_spread_threshold)
+
+    # Sources are only quantized at the end, so error is computed from the values before dithering
+    for x in range(x_len):
+        if full_model[x, y, z, 0] == 1.0:
+            max_i = full_model[x, y, z, 1:].argmax() + 1
+            max_index[x, y, z] = max_i
+            for i in range(1, full_model.shape[3]):
+                old = full_model[x, y, z, i]
+                if old != 0:
+                    if i == max_i:
+                        error = old - np.float32(1)
+                    else:
+                        error = old - np.float32(0)
+
+                    for k in in_row:
+                        tx = x + offsets[k, 0]
+                        if weights[k] != 0 and tx < x_len and not locked[tx, y, z]:
+                            full_model[tx, y, z, i] += error * weights[k] * full_model[tx, y, z, 0]
+                            if full_model[tx, y, z, i] > error_spread_threshold:
+                                locked[tx, y, z] = True
+
+@njit(parallel=True, cache=True)
+def ditherWavefront(full_model, offsets, weights, lag, rows, edge_x, edge_y, in_row, error_spread_threshold):
+    # Rows of voxels at the same step are independent and are dithered in parallel. Each row collects
+    # error from earlier rows and only writes to itself, so the result does not depend on thread
+    # scheduling and matches ditherDiffusion.
+    x_len = full_model.shape[0]
+    y_len = full_model.shape[1]
+    z_len = full_model.shape[2]
+
+    locked = np.zeros((x_len, y_len, z_len), dtype=np.bool_)
+    for z in prange(z_len):
+        lockVoxels(full_model, locked, z, error_spread_threshold)
+
+    # Quantized material of each voxel, or 0 if the voxel is not dithered
+    max_index = np.zeros((x_len, y_len, z_len), dtype=np.int32)
+
+    for t in range((y_len - 1) + lag * (z_len - 1) + 1):
+        z_min = max(0, -((y_len - 1 - t) // lag))
+        z_max = min(z_len - 1, t // lag)
+
+        for zi in prange(z_max - z_min + 1):
+            z = z_min + zi
+            y = t - (lag * z)
+            keys = np.zeros(8 * len(weights), dtype=np.int64)
+            stencil_ids = np.zeros(8 * len(weights), dtype=np.int64)
+            ditherRow(full_model, locked, max_index, offsets, weights, rows, edge_x, edge_y, in_row, keys, stencil_ids, y, z, error_spread_threshold)
+
+    for z in prange(z_len):
         for y in range(y_len):
             for x in range(x_len):
-                voxel = full_model[x, y, z]
-                if voxel[0] == 1.0:
-                    max_i = voxel[1:].argmax()+1
-                    for i in range(1, len(voxel)):
+                max_i = max_index[x, y, z]
+                if max_i > 0:
+                    for i in range(1, full_model.shape[3]):
                         if full_model[x, y, z, i] != 0:
-                            old = full_model[x, y, z, i]
-
                             if i == max_i:
                                 full_model[x, y, z, i] = 1
                             else:
                                 full_model[x, y, z, i] = 0
 
-                            error = old - full_model[x, y, z, i]
-
-                            if use_full:
-                                # Based on Fundamentals of 3D Halftoning by Lou and Stucki
-                                addError(full_model, error, 4/21, i, x+1, y, z, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, 1/21, i, x+2, y, z, x_len, y_len, z_len, error_spread_threshold)
-
-                                addError(full_model, error, 4/21, i, x, y+1, z, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, 1/21, i, x, y+2, z, x_len, y_len, z_len, error_spread_threshold)
-
-                                addError(full_model, error, 1/21, i, x+1, y+1, z, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, 1/21, i, x-1, y+1, z, x_len, y_len, z_len, error_spread_threshold)
+    return full_model
 
-                                addError(full_model, error, 1/21, i, x, y-1, z+1, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, 1/21, i, x-1, y, z+1, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, 1/21, i, x, y+1, z+1, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, 1/21, i, x+1, y, z+1, x_len, y_len, z_len, error_spread_threshold)
+def wavefrontStencil(offsets, shape):
+    # Stencil entries that spread error to other rows, sorted so that sources are in processing order,
+    # the entries that spread error along the row, and the x and y above which sources can wrap around
+    rows = [k for k in range(len(offsets)) if offsets[k, 1] != 0 or offsets[k, 2] != 0]
+    rows = np.array(sorted(rows, key=lambda k: (-offsets[k, 2], -offsets[k, 1], -offsets[k, 0])), dtype=np.int64)
+    in_row = np.array([k for k in range(len(offsets)) if offsets[k, 1] == 0 and offsets[k, 2] == 0], dtype=np.int64)
+    edge_x = shape[0] + min(0, int(offsets[rows, 0].min())) if len(rows) > 0 else shape[0]
+    edge_y = shape[1] + min(0, int(offsets[rows, 1].min())) if len(rows) > 0 else shape[1]
+    return rows, edge_x, edge_y, in_row
+
+def ditherStreaming(voxels, materials, offsets, weights, error_spread_threshold, out=None):
+    # Dither an indexed model one z plane at a time. Error is only spread a few planes ahead (2 for
+    # Lou-Stucki), so only those planes of full materials are kept in memory. Output planes are
+    # written to out, which can be a preallocated or memory-mapped array.
+    x_len, y_len, z_len = voxels.shape
+    materials = np.asarray(materials, dtype=np.float32)
+    n_materials = materials.shape[1]
+    depth = int(offsets[:, 2].max()) + 1
+
+    if out is None:
+        out = np.zeros((x_len, y_len, z_len), dtype=np.int32)
+
+    ring = np.zeros((x_len, y_len, depth, n_materials), dtype=np.float32)
+    locked = np.zeros((x_len, y_len, depth), dtype=np.bool_)
+    for z in range(min(depth, z_len)):
+        ring[:, :, z] = materials[voxels[:, :, z]]
+        lockVoxels(ring, locked, z, error_spread_threshold)
+
+    # Materials are numbered by first appearance in x, y, z loop order to match toIndexedMaterials
+    new_materials = [np.zeros(n_materials, dtype=np.float32)]
+    palette = {new_materials[0].tobytes(): 0}
+    first = [-1]
+    plane_index = ((np.arange(x_len)[:, None] * y_len + np.arange(y_len)[None, :]) * z_len).ravel()
 
-                                addError(full_model, error, 4/21, i, x, y, z+1, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, 1/21, i, x, y, z+2, x_len, y_len, z_len, error_spread_threshold)
-                            else:
-                                addError(full_model, error, x_error, i, x+1, y, z, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, y_error, i, x, y+1, z, x_len, y_len, z_len, error_spread_threshold)
-                                addError(full_model, error, z_error, i, x, y, z+1, x_len, y_len, z_len, error_spread_threshold)
+    for z in range(z_len):
+        diffusePlane(ring, locked, z, z_len, offsets, weights, error_spread_threshold)
+
+        plane_voxels, plane_materials = internMaterials(ring[:, :, z % depth])
+        plane_ids, plane_first = np.unique(plane_voxels.ravel(), return_index=True)
+
+        lookup = np.zeros(len(plane_materials), dtype=np.int32)
+        for j, f in zip(plane_ids, plane_index[plane_first] + z):
+            key = plane_materials[j].tobytes()
+            if key not in palette:
+                palette[key] = len(new_materials)
+                new_materials.append(plane_materials[j])
+                first.append(f)
+            lookup[j] = palette[key]
+            first[lookup[j]] = min(first[lookup[j]], f)
+
+        out[:, :, z] = lookup[plane_voxels]
+
+        if z + depth < z_len:
+            ring[:, :, z % depth] = materials[voxels[:, :, z + depth]]
+            lockVoxels(ring, locked, z + depth, error_spread_threshold)
+
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    for z in range(z_len):
+        out[:, :, z] = rank[out[:, :, z]]
+
+    return out, np.array(new_materials, dtype=np.float32)[order]
+
+def bayerMatrix(order=3):
+    # 3D Bayer index matrix of size 2^order. Each 2x2x2 step fills a tetrahedron before its complement.
+    base = np.zeros((2, 2, 2), dtype=np.int32)
+    for rank, (x, y, z) in enumerate([(0, 0, 0), (1, 1, 0), (1, 0, 1), (0, 1, 1), (1, 1, 1), (0, 0, 1), (0, 1, 0), (1, 0, 0)]):
+        base[x, y, z] = rank
+
+    matrix = np.zeros((1, 1, 1), dtype=np.int32)
+    for i in range(order):
+        n = matrix.shape[0]
+        matrix = (8 * np.tile(matrix, (2, 2, 2))) + base.repeat(n, 0).repeat(n, 1).repeat(n, 2)
+
+    return matrix
+
+def thresholdMask(mask):
+    # Convert a mask name or index matrix to thresholds in (0, 1)
+    if isinstance(mask, str):
+        if mask == 'bayer':
+            mask = bayerMatrix()
+        elif mask == 'blue_noise':
+            mask = loadBlueNoise()
+        else:
+            raise ValueError('Unknown threshold mask: ' + mask)
+
+    mask = np.asarray(mask)
+    return ((np.argsort(np.argsort(mask, axis=None)).reshape(mask.shape) + 0.5) / mask.size).astype(np.float32)
+
+def ditherThreshold(voxels, materials, mask, chunk_size=64):
+    # Ordered dither: each fully dense voxel takes the material whose cumulative fraction first exceeds
+    # the tiled threshold at that voxel. Works directly on the indexed model, one x slab at a time.
+    x_len, y_len, z_len = voxels.shape
+    thresholds = thresholdMask(mask)
+    m_x, m_y, m_z = thresholds.shape
+    materials = np.asarray(materials, dtype=np.float32)
+    n_materials = materials.shape[1]
+
+    # Dense voxels without any material are left as they are, as in error diffusion
+    cumulative = np.cumsum(materials[:, 1:], axis=1)
+    dense = (materials[:, 0] == 1.0) & (cumulative[:, -1] > 0)
+    cumulative = cumulative / np.where(cumulative[:, -1:] > 0, cumulative[:, -1:], 1)
+
+    # Materials after dithering: the original palette for voxels that are not dithered, followed by one single-material entry per channel
+    single = np.zeros((n_materials - 1, n_materials), dtype=np.float32)
+    single[:, 0] = 1
+    single[:, 1:] = np.eye(n_materials - 1)
+    new_materials = np.vstack((materials, single))
 
-    return full_model
+    new_voxels = np.zeros((x_len, y_len, z_len), dtype=np.int32)
+    tile_y = np.arange(y_len) % m_y
+    tile_z = np.arange(z_len) % m_z
+
+    for x_start in range(0, x_len, chunk_size):
+        x_end = min(x_start + chunk_size, x_len)
+        v = voxels[x_start:x_end]
+        t = thresholds[np.ix_(np.arange(x_start, x_end) % m_x, tile_y, tile_z)]
+        choice = (cumulative[v] <= t[..., None]).sum(axis=-1)
+        choice = np.minimum(choice, n_materials - 2)
+        new_voxels[x_start:x_end] = np.where(dense[v], len(materials) + choice, v)
+
+    return reindexMaterials(new_voxels, new_materials)
+
+def localDensityError(model, dithered_model, radius=2):
+    # RMS difference between the input material fractions and the local material fractions of a dithered model
+    # Local fractions are found with a gaussian filter using the same radius convention as VoxelModel.blur
+    target = model.scaleValues()
+    mask = target.materials[target.voxels, 0] == 1.0
+    if not np.any(mask):
+        return 0.0
+
+    error = 0.0
+    for m in range(1, target.materials.shape[1]):
+        if not (np.any(target.materials[:, m] != 0) or np.any(dithered_model.materials[:, m] != 0)):
+            continue
+        local = ndimage.gaussian_filter(dithered_model.materials[dithered_model.voxels, m].astype(np.float32), sigma=radius/2)
+        error += np.sum((local[mask] - target.materials[target.voxels, m][mask]) ** 2)
+
+    return float(np.sqrt(error / np.sum(mask)))
 
 def memory_usage_psutil():
     # return the memory usage in MB
@@ -115,25 +565,67 @@ def memory_usage_psutil():
     mem = process.memory_info()[0] / float(2 ** 20)
     return [cpu, mem]
 
-def dither(model, radius=1, use_full=True, x_error=0.0, y_error=0.0, z_error=0.0, error_spread_threshold=0.8, blur=True, mem_use_log=[]):
+def dither(model, radius=1, use_full=True, x_error=0.0, y_error=0.0, z_error=0.0, error_spread_threshold=0.8, blur=True, mem_use_log=None, compact=True, streaming=False, out=None, parallel=False, threshold_mask=None, stencil=None):
+    if mem_use_log is None:
+        mem_use_log = []
+
     if radius == 0:
         return VoxelModel.copy(model)
 
     if blur:
-        new_model = model.blur(radius)
+        with span('blur'):
+            new_model = blurModel(model, radius)
+        mem_use_log.append(memory_usage_psutil())
+        with span('scaleValues'):
+            new_model = new_model.scaleValues()
         mem_use_log.append(memory_usage_psutil())
-        new_model = new_model.scaleValues()
+    else:
+        with span('scaleValues'):
+            new_model = model.scaleValues()
+        mem_use_log.append(memory_usage_psutil())
+
+    # Only expand the material channels that are present in the model
+    if compact:
+        channels = activeChannels(new_model.materials, error_spread_threshold)
+    else:
+        channels = np.arange(len(material_properties)+1)
+
+    if threshold_mask is not None:
+        with span('ditherThreshold', mask=threshold_mask if isinstance(threshold_mask, str) else 'array'):
+            new_voxels, new_materials = ditherThreshold(new_model.voxels, new_model.materials[:, channels], threshold_mask)
         mem_use_log.append(memory_usage_psutil())
+        new_materials = expandChannels(new_materials, channels, len(material_properties) + 1)
+        return VoxelModel(new_voxels, new_materials, model.coords, model.resolution), mem_use_log
+
+    # Error diffusion stencil, either given directly or set by use_full and x/y/z_error
+    if stencil is None:
+        offsets, weights = ditherStencil(use_full, x_error, y_error, z_error)
     else:
-        new_model = model.scaleValues()
+        offsets, weights = stencilArrays(stencil)
+
+    if streaming:
+        with span('ditherStreaming'):
+            new_voxels, new_materials = ditherStreaming(new_model.voxels, new_model.materials[:, channels], offsets, weights, error_spread_threshold, out)
         mem_use_log.append(memory_usage_psutil())
+        new_materials = expandChannels(new_materials, channels, len(material_properties) + 1)
+        return VoxelModel(new_voxels, new_materials, model.coords, model.resolution), mem_use_log
 
-    full_model = toFullMaterials(new_model.voxels, new_model.materials, len(material_properties)+1)
+    with span('toFullMaterials', channels=len(channels)):
+        full_model = toFullMaterials(new_model.voxels, new_model.materials[:, channels], len(channels))
     mem_use_log.append(memory_usage_psutil())
-    full_model = ditherOptimized(full_model, use_full, x_error, y_error, z_error, error_spread_threshold)
+    if stencil is None and not use_full and z_error == 0:
+        with span('ditherSlices'):
+            full_model = ditherSlices(full_model, x_error, y_error, error_spread_threshold)
+    elif parallel:
+        with span('ditherWavefront'):
+            full_model = ditherWavefront(full_model, offsets, weights, wavefrontLag(offsets), *wavefrontStencil(offsets, full_model.shape), error_spread_threshold)
+    else:
+        with span('ditherDiffusion'):
+            full_model = ditherDiffusion(full_model, offsets, weights, error_spread_threshold)
     mem_use_log.append(memory_usage_psutil())
 
-    return toIndexedMaterials(full_model, model), mem_use_log
+    with span('toIndexedMaterials'):
+        return toIndexedMaterials(full_model, model, channels), mem_use_log
 
 if __name__ == '__main__':
     app1 = qg.QApplication(sys.argv)
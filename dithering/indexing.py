@@ -0,0 +1,63 @@
+import numpy as np
+
+from voxelfuse.voxel_model import VoxelModel
+
+def rowKeys(rows):
+    # View each row as a single opaque value so rows can be sorted/compared in one pass
+    rows = np.ascontiguousarray(rows)
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+def internMaterials(full_model):
+    # Convert a full material array (x, y, z, n) to (voxels, materials)
+    # Materials are numbered in order of first appearance (x, y, z loop order), with the empty material at index 0
+    n_materials = full_model.shape[-1]
+    rows = np.ascontiguousarray(full_model, dtype=np.float32).reshape(-1, n_materials)
+
+    _, first, inverse = np.unique(rowKeys(rows), return_index=True, return_inverse=True)
+
+    # Add the empty material and merge rows that only differ by the sign of a zero
+    palette = np.vstack((np.zeros((1, n_materials), dtype=np.float32), rows[first] + np.float32(0)))
+    first = np.concatenate(([-1], first))
+    _, merged_index, merged_inverse = np.unique(rowKeys(palette), return_index=True, return_inverse=True)
+
+    group_first = np.full(len(merged_index), len(rows), dtype=np.int64)
+    np.minimum.at(group_first, merged_inverse, first)
+
+    # Renumber materials by first appearance
+    order = np.argsort(group_first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    new_materials = palette[merged_index[order]]
+    new_voxels = rank[merged_inverse[1:]][inverse].astype(np.int32).reshape(full_model.shape[:-1])
+
+    return new_voxels, new_materials
+
+def removeDuplicateMaterials(model):
+    # Equivalent to VoxelModel.removeDuplicateMaterials, but remaps all voxels with a single lookup
+    new_materials, inverse = np.unique(model.materials + 0.0, axis=0, return_inverse=True)
+    new_voxels = inverse.reshape(-1)[model.voxels].astype(model.voxels.dtype)
+    return VoxelModel(new_voxels, new_materials, model.coords, model.resolution)
+
+def reindexMaterials(voxels, materials):
+    # Remove unused and duplicate materials from an indexed model
+    # Gives the same result as internMaterials(materials[voxels]) without expanding the model
+    n_materials = materials.shape[1]
+    palette = np.vstack((np.zeros((1, n_materials), dtype=np.float32), np.asarray(materials, dtype=np.float32) + np.float32(0)))
+    _, merged_index, merged_inverse = np.unique(rowKeys(palette), return_index=True, return_inverse=True)
+
+    ids, first = np.unique(voxels.ravel(), return_index=True)
+    group_first = np.full(len(merged_index), voxels.size, dtype=np.int64)
+    group_first[merged_inverse[0]] = -1
+    np.minimum.at(group_first, merged_inverse[ids + 1], first)
+
+    # Renumber the materials that are used by first appearance
+    keep = np.flatnonzero(group_first < voxels.size)
+    keep = keep[np.argsort(group_first[keep], kind='stable')]
+    rank = np.zeros(len(merged_index), dtype=np.int32)
+    rank[keep] = np.arange(len(keep))
+
+    new_materials = palette[merged_index[keep]]
+    new_voxels = rank[merged_inverse[1:]][voxels].astype(np.int32)
+
+    return new_voxels, new_materials
@@ -0,0 +1,66 @@
+import numpy as np
+
+from voxelfuse.voxel_model import VoxelModel
+
+from dithering.indexing import internMaterials
+
+# Resampling between a model and a coarser processing grid
+# Each processing voxel covers a block of factor^3 model voxels, with the blocks aligned to the model origin
+# Both directions work on the indexed models in slabs along x, so only one slab of full materials exists at a time
+
+CHUNK_SIZE = 2 ** 22    # max model voxels resampled at once
+
+def blockCount(length, factor):
+    return -(-length // factor)
+
+def downsampleModel(model, factor):
+    # Average material fractions of the occupied voxels in each block
+    # A processing voxel is occupied if any voxel in its block is, so the upsampled result covers the whole model
+    factor = int(factor)
+    materials = np.asarray(model.materials, dtype=np.float32)
+    occupied = materials[:, 0] > 0
+    used = np.unique(model.voxels)
+    active = [c for c in range(1, materials.shape[1]) if (materials[used, c] != 0).any()]
+    weights = np.where(occupied[:, None], materials[:, [0] + active], 0).astype(np.float32)
+    weights[:, 0] = occupied
+
+    x_len, y_len, z_len = model.voxels.shape
+    shape = (blockCount(x_len, factor), blockCount(y_len, factor), blockCount(z_len, factor))
+    totals = np.zeros(shape + (len(active) + 1,), dtype=np.float64)
+
+    # Slabs of whole blocks
+    step = factor * max(1, CHUNK_SIZE // (factor ** 3 * shape[1] * shape[2]))
+    for x_start in range(0, x_len, step):
+        voxels = model.voxels[x_start:x_start + step]
+        n_blocks = blockCount(voxels.shape[0], factor)
+        slab = np.zeros((n_blocks * factor, shape[1] * factor, shape[2] * factor, len(active) + 1), dtype=np.float32)
+        slab[:voxels.shape[0], :y_len, :z_len] = weights[voxels]
+        slab = slab.reshape(n_blocks, factor, shape[1], factor, shape[2], factor, -1)
+        totals[x_start // factor:x_start // factor + n_blocks] = slab.sum(axis=(1, 3, 5), dtype=np.float64)
+
+    count = totals[..., :1]
+    full = np.empty(totals.shape, dtype=np.float32)
+    full[..., 0] = count[..., 0] > 0
+    full[..., 1:] = totals[..., 1:] / np.maximum(count, 1)
+
+    voxels, active_materials = internMaterials(full)
+    new_materials = np.zeros((len(active_materials), materials.shape[1]), dtype=np.float32)
+    new_materials[:, [0] + active] = active_materials
+    return VoxelModel(voxels, new_materials, model.coords, model.resolution / factor)
+
+def upsampleModel(model, factor, footprint):
+    # Nearest upsampling of a processing grid model, trimmed to the occupied voxels of footprint
+    # footprint is the model that was downsampled, the result has its size and position
+    factor = int(factor)
+    x_len, y_len, z_len = footprint.voxels.shape
+    y_index = np.arange(y_len) // factor
+    z_index = np.arange(z_len) // factor
+
+    voxels = np.zeros(footprint.voxels.shape, dtype=model.voxels.dtype)
+    step = max(1, CHUNK_SIZE // (y_len * z_len))
+    for x_start in range(0, x_len, step):
+        x_end = min(x_start + step, x_len)
+        block = model.voxels[np.ix_(np.arange(x_start, x_end) // factor, y_index, z_index)]
+        voxels[x_start:x_end] = np.where(footprint.voxels[x_start:x_end] != 0, block, 0)
+
+    return VoxelModel(voxels, model.materials, footprint.coords, footprint.resolution)
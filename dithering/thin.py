@@ -1,7 +1,11 @@
 import PyQt5.QtGui as qg
+import os
 import sys
+import shutil
+import tempfile
 
 import numpy as np
+from numba import njit, prange
 from scipy import ndimage
 from tqdm import tqdm
 
@@ -10,18 +14,72 @@ from voxelfuse.plot import Plot
 from voxelfuse.primitives import cuboid
 from voxelfuse.voxel_model import VoxelModel
 from voxelfuse.voxel_model import Axes
-from voxelfuse.voxel_model import Struct
 
 from dithering.dither import dither
+from dithering.thin_table import deletable
 
-def thin(model, max_iter):
-    x_len = model.voxels.shape[0] + 4
-    y_len = model.voxels.shape[1] + 4
-    z_len = model.voxels.shape[2] + 4
+@njit(cache=True)
+def isCenterline(voxels, x, y, z, sphere, stack, visited):
+    # True if the exterior voxel at (x, y, z) must be part of the center line
+    # Find V - number of voxels near current along xyz axes
+    Vx = 0
+    Vy = 0
+    Vz = 0
+    for d in range(-2, 3):
+        Vx += voxels[x + d, y, z] != 0
+        Vy += voxels[x, y + d, z] != 0
+        Vz += voxels[x, y, z + d] != 0
+    if (Vx <= 2) or (Vy <= 2) or (Vz <= 2):
+        return True
+
+    # Count the 26-connected components of the 5x5x5 neighborhood after subtracting the sphere
+    visited[:] = False
+    C = 0
+    for i in range(5):
+        for j in range(5):
+            for k in range(5):
+                if visited[i, j, k] or sphere[i, j, k] or voxels[x + i - 2, y + j - 2, z + k - 2] == 0:
+                    continue
+
+                C += 1
+                if C > 1:
+                    return True
+
+                # Flood fill the component
+                visited[i, j, k] = True
+                stack[0, 0] = i
+                stack[0, 1] = j
+                stack[0, 2] = k
+                n = 1
+                while n > 0:
+                    n -= 1
+                    a = stack[n, 0]
+                    b = stack[n, 1]
+                    c = stack[n, 2]
+                    for da in range(max(a - 1, 0), min(a + 2, 5)):
+                        for db in range(max(b - 1, 0), min(b + 2, 5)):
+                            for dc in range(max(c - 1, 0), min(c + 2, 5)):
+                                if not visited[da, db, dc] and not sphere[da, db, dc] and voxels[x + da - 2, y + db - 2, z + dc - 2] != 0:
+                                    visited[da, db, dc] = True
+                                    stack[n, 0] = da
+                                    stack[n, 1] = db
+                                    stack[n, 2] = dc
+                                    n += 1
+    return False
 
-    struct = ndimage.generate_binary_structure(3, 3)
+@njit(parallel=True, cache=True)
+def centerlineVoxels(voxels, coords, sphere, chunk_size=256):
+    # Test each exterior voxel in coords, in parallel chunks that share a stack buffer
+    keep = np.zeros(len(coords), dtype=np.bool_)
+    for chunk in prange((len(coords) + chunk_size - 1) // chunk_size):
+        stack = np.empty((125, 3), dtype=np.int64)
+        visited = np.empty((5, 5, 5), dtype=np.bool_)
+        for i in range(chunk * chunk_size, min((chunk + 1) * chunk_size, len(coords))):
+            keep[i] = isCenterline(voxels, coords[i, 0], coords[i, 1], coords[i, 2], sphere, stack, visited)
+    return keep
 
-    sphere = np.zeros((5, 5, 5), dtype=np.int32)
+def sphereMask():
+    sphere = np.zeros((5, 5, 5), dtype=np.bool_)
     for x in range(5):
         for y in range(5):
             for z in range(5):
@@ -32,64 +90,231 @@ def thin(model, max_iter):
 
                 if r < 2.5:
                     sphere[x, y, z] = 1
+    return sphere
 
-    input_model = VoxelModel(np.zeros((x_len, y_len, z_len), dtype=np.int32), model.materials, model.coords)
-    input_model.voxels[2:-2, 2:-2, 2:-2] = model.voxels
-    new_model = VoxelModel.emptyLike(input_model)
+def interiorMask(occupied):
+    # Same as erode(radius=1, connectivity=1), voxels on the edge of the array are exterior
+    interior = np.zeros_like(occupied)
+    core = occupied[1:-1, 1:-1, 1:-1]
+    interior[1:-1, 1:-1, 1:-1] = (core & occupied[:-2, 1:-1, 1:-1] & occupied[2:, 1:-1, 1:-1] & occupied[1:-1, :-2, 1:-1]
+                                  & occupied[1:-1, 2:, 1:-1] & occupied[1:-1, 1:-1, :-2] & occupied[1:-1, 1:-1, 2:])
+    return interior
 
-    for i in tqdm(range(max_iter), desc='Thinning'):
-        # Find exterior voxels
-        interior_voxels = input_model.erode(radius=1, plane=Axes.XYZ, structType=Struct.STANDARD, connectivity=1)
-        exterior_voxels = input_model.difference(interior_voxels)
-
-        x_len = len(exterior_voxels.voxels[:, 0, 0])
-        y_len = len(exterior_voxels.voxels[0, :, 0])
-        z_len = len(exterior_voxels.voxels[0, 0, :])
-
-        # Create list of exterior voxel coordinates
-        exterior_coords = []
-        for x in range(x_len):
-            for y in range(y_len):
-                for z in range(z_len):
-                    if exterior_voxels.voxels[x, y, z] != 0:
-                        exterior_coords.append([x, y, z])
+# 6-neighbors of a voxel
+FACES = np.array([(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)], dtype=np.int64)
 
-        # Store voxels that must be part of the center line
-        for coords in exterior_coords:
-            x = coords[0]
-            y = coords[1]
-            z = coords[2]
+def frontierNeighbors(voxels, coords):
+    # Occupied 6-neighbors of the voxels in coords, each listed once
+    neighbors = (coords[:, None, :] + FACES[None, :, :]).reshape(-1, 3)
+    neighbors = neighbors[voxels[neighbors[:, 0], neighbors[:, 1], neighbors[:, 2]] != 0]
+    index = np.unique(np.ravel_multi_index(neighbors.T, voxels.shape))
+    return np.stack(np.unravel_index(index, voxels.shape), axis=1)
 
-            if input_model.voxels[x,y,z] != 0:
-                # Get matrix of neighbors
-                n = np.copy(input_model.voxels[x - 2:x + 3, y - 2:y + 3, z - 2:z + 3])
-                n[n != 0] = 1
+def thin(model, max_iter):
+    x_len = model.voxels.shape[0] + 4
+    y_len = model.voxels.shape[1] + 4
+    z_len = model.voxels.shape[2] + 4
 
-                # Find V - number of voxels near current along xyz axes
-                Vx = np.sum(n[:, 2, 2])
-                Vy = np.sum(n[2, :, 2])
-                Vz = np.sum(n[2, 2, :])
+    sphere = sphereMask()
 
-                # Subtract sphere
-                n = n - sphere
-                n[n < 1] = 0
+    voxels = np.zeros((x_len, y_len, z_len), dtype=np.int32)
+    voxels[2:-2, 2:-2, 2:-2] = model.voxels
+    new_model = VoxelModel(np.zeros((x_len, y_len, z_len), dtype=np.uint16), model.materials, model.coords)
 
-                # Check if subtraction split model
-                C = ndimage.label(n, structure=struct)[1]
+    # Each iteration removes the exterior voxels, the next exterior is the voxels uncovered by removing them
+    # so only the queue of exterior voxels is visited instead of the whole volume
+    occupied = voxels != 0
+    exterior_coords = np.argwhere(occupied & ~interiorMask(occupied))
 
-                # Apply conditions
-                if (C > 1) or (Vx <= 2) or (Vy <= 2) or (Vz <= 2):
-                    new_model.voxels[x, y, z] = input_model.voxels[x, y, z]
+    for i in tqdm(range(max_iter), desc='Thinning'):
+        # Store voxels that must be part of the center line
+        keep = exterior_coords[centerlineVoxels(voxels, exterior_coords, sphere)]
+        new_model.voxels[keep[:, 0], keep[:, 1], keep[:, 2]] = voxels[keep[:, 0], keep[:, 1], keep[:, 2]]
+
+        exterior = (exterior_coords[:, 0], exterior_coords[:, 1], exterior_coords[:, 2])
+        exterior_values = voxels[exterior]
+        voxels[exterior] = 0
+        exterior_coords = frontierNeighbors(voxels, exterior_coords)
 
-        if np.sum(interior_voxels.voxels) < 1:
+        if len(exterior_coords) == 0:
+            # No interior voxels left, keep the last layer
+            voxels[exterior] = exterior_values
             break
-        else:
-            input_model = VoxelModel.copy(interior_voxels)
 
-    new_model = new_model.union(input_model)
+    new_model = new_model.union(VoxelModel(voxels, model.materials, model.coords))
 
     return new_model
 
+def brickRanges(shape, brick_size):
+    # (x, y, z) index ranges of the bricks covering an array
+    starts = [range(0, length, brick_size) for length in shape]
+    return [((x, min(x + brick_size, shape[0])), (y, min(y + brick_size, shape[1])), (z, min(z + brick_size, shape[2])))
+            for x in starts[0] for y in starts[1] for z in starts[2]]
+
+def readBrick(voxels, ranges, halo):
+    # Brick with halo voxels on each side, voxels outside the array are empty
+    tile = np.zeros(tuple(end - start + 2 * halo for start, end in ranges), dtype=voxels.dtype)
+    source = tuple(slice(max(start - halo, 0), min(end + halo, length)) for (start, end), length in zip(ranges, voxels.shape))
+    target = tuple(slice(s.start - start + halo, s.stop - start + halo) for s, (start, _) in zip(source, ranges))
+    tile[target] = voxels[source]
+    return tile
+
+def thinTiled(voxels, materials, max_iter, out=None, brick_size=64, folder=None):
+    # Same as thin(VoxelModel(voxels, materials), max_iter), returns the voxels and materials of the result
+    # For volumes that do not fit in memory: voxels and out can be memory-mapped arrays, the model is processed
+    # one brick at a time and the intermediate models are stored in memory-mapped files in folder
+    # Each iteration reads the previous model and writes the next, so a brick only needs the 2 voxel halo
+    # of the centerline test and decisions at brick seams are the same as for the whole model
+    x_len = voxels.shape[0] + 4
+    y_len = voxels.shape[1] + 4
+    z_len = voxels.shape[2] + 4
+
+    sphere = sphereMask()
+
+    if out is None:
+        out = np.zeros((x_len, y_len, z_len), dtype=np.uint16)
+    else:
+        out[...] = 0
+
+    work_folder = tempfile.mkdtemp(dir=folder)
+    try:
+        current = np.lib.format.open_memmap(os.path.join(work_folder, 'current.npy'), mode='w+', dtype=np.uint16, shape=(x_len, y_len, z_len))
+        following = np.lib.format.open_memmap(os.path.join(work_folder, 'following.npy'), mode='w+', dtype=np.uint16, shape=(x_len, y_len, z_len))
+        for (x0, x1), (y0, y1), (z0, z1) in brickRanges(voxels.shape, brick_size):
+            current[x0 + 2:x1 + 2, y0 + 2:y1 + 2, z0 + 2:z1 + 2] = voxels[x0:x1, y0:y1, z0:z1]
+
+        # Bricks that are empty in the current and following model are skipped
+        bricks = brickRanges(current.shape, brick_size)
+        current_count = np.ones(len(bricks), dtype=np.int64)
+        following_count = np.zeros(len(bricks), dtype=np.int64)
+
+        for i in tqdm(range(max_iter), desc='Thinning'):
+            for b, ranges in enumerate(bricks):
+                core = tuple(slice(start, end) for start, end in ranges)
+                if current_count[b] == 0:
+                    if following_count[b] != 0:
+                        following[core] = 0
+                        following_count[b] = 0
+                    continue
+
+                tile = readBrick(current, ranges, 2)
+                inner = tuple(slice(2, end - start + 2) for start, end in ranges)
+                occupied = tile != 0
+                interior = interiorMask(occupied)
+                exterior = np.zeros_like(occupied)
+                exterior[inner] = occupied[inner] & ~interior[inner]
+
+                # Store voxels that must be part of the center line
+                exterior_coords = np.argwhere(exterior)
+                keep = exterior_coords[centerlineVoxels(tile, exterior_coords, sphere)]
+                out[core][keep[:, 0] - 2, keep[:, 1] - 2, keep[:, 2] - 2] = tile[keep[:, 0], keep[:, 1], keep[:, 2]]
+
+                following[core] = np.where(interior[inner], tile[inner], 0)
+                following_count[b] = np.count_nonzero(interior[inner])
+
+            if following_count.sum() < 1:
+                break
+            else:
+                current, following = following, current
+                current_count, following_count = following_count, current_count
+
+        # Union of the centerline and the remaining voxels, as in thin
+        offset = len(materials) - 1
+        for ranges in bricks:
+            core = tuple(slice(start, end) for start, end in ranges)
+            brick_out = out[core]
+            remaining = current[core].astype(np.uint16)
+            out[core] = np.where(brick_out != 0, brick_out, np.where(remaining != 0, remaining + offset, 0))
+
+        del current, following
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    return out, np.vstack((materials, materials[1:]))
+
+# Subiteration directions as (axis, step), border voxels in a direction have an empty neighbor on that side
+DIRECTIONS = [(2, 1), (2, -1), (1, 1), (1, -1), (0, 1), (0, -1)]
+
+# Subfields of voxels with the same parity in x, y, z, no two voxels in a subfield are neighbors
+SUBFIELDS = [(x, y, z) for x in range(2) for y in range(2) for z in range(2)]
+
+def thinVoxels(occupied, max_iter, coords=None):
+    # Thin the occupied array in place, occupied needs at least one empty voxel of padding
+    # coords -- all occupied voxels, if known, to avoid searching the whole array
+    # Only voxels with an empty 6-neighbor can be removed, the list of them is updated as voxels are removed
+    if coords is None:
+        coords = np.argwhere(occupied)
+    neighbors = coords[:, None, :] + FACES[None, :, :]
+    coords = coords[~occupied[neighbors[..., 0], neighbors[..., 1], neighbors[..., 2]].all(axis=1)]
+    queued = np.zeros(occupied.shape, dtype=np.bool_)
+    queued[coords[:, 0], coords[:, 1], coords[:, 2]] = True
+
+    for i in tqdm(range(max_iter), desc='Thinning'):
+        removed = 0
+        for axis, step in DIRECTIONS:
+            # Border voxels at the start of the subiteration
+            neighbors = np.copy(coords)
+            neighbors[:, axis] += step
+            candidates = coords[~occupied[neighbors[:, 0], neighbors[:, 1], neighbors[:, 2]]]
+            subfield = (candidates % 2) @ (4, 2, 1)
+
+            deleted = []
+            for s in range(len(SUBFIELDS)):
+                subfield_candidates = candidates[subfield == s]
+                subfield_candidates = subfield_candidates[deletable(occupied, subfield_candidates)]
+                occupied[subfield_candidates[:, 0], subfield_candidates[:, 1], subfield_candidates[:, 2]] = False
+                deleted.append(subfield_candidates)
+            deleted = np.concatenate(deleted)
+            removed += len(deleted)
+
+            # Neighbors of removed voxels are now on the border
+            new_coords = frontierNeighbors(occupied, deleted)
+            new_coords = new_coords[~queued[new_coords[:, 0], new_coords[:, 1], new_coords[:, 2]]]
+            queued[new_coords[:, 0], new_coords[:, 1], new_coords[:, 2]] = True
+            coords = np.concatenate((coords[occupied[coords[:, 0], coords[:, 1], coords[:, 2]]], new_coords))
+
+        if removed == 0:
+            break
+
+    return occupied
+
+def thinCurve(model, max_iter):
+    # Topology preserving curve thinning with 6 directional subiterations
+    # Each subiteration is split into subfields, so every deletable border voxel of a subfield can be removed at once
+    occupied = np.pad(model.voxels != 0, 1)
+    thinVoxels(occupied, max_iter)
+
+    new_voxels = np.where(occupied[1:-1, 1:-1, 1:-1], model.voxels, 0)
+    return VoxelModel(new_voxels, model.materials, model.coords, model.resolution)
+
+def thinMultiresolution(model, factor, band=0, max_iter=100):
+    # Centerline of model.scale(factor), without thinning the whole scaled model
+    # The model is thinned at its own resolution, then the scaled model is re-thinned only within
+    # the scaled voxels of that centerline, widened by band voxels (at the original resolution)
+    # A band can join branches of the centerline that pass close to each other
+    factor = int(factor)
+    coarse = thinCurve(model, max_iter).voxels != 0
+    band_coords = np.argwhere(ndimage.binary_dilation(coarse, iterations=band, mask=model.voxels != 0) if band > 0 else coarse)
+
+    new_voxels = np.zeros(tuple(np.array(model.voxels.shape) * factor), dtype=model.voxels.dtype)
+    if len(band_coords) == 0:
+        return VoxelModel(new_voxels, model.materials, model.coords, model.resolution * factor)
+
+    # Scaled voxels of the band, relative to the scaled bounding box of the band, with one voxel of padding
+    # The thinning array only covers that bounding box, the result is a full size array like model.scale(factor)
+    # The box starts at even coordinates so the voxels keep their subfields
+    origin = band_coords.min(axis=0) * factor // 2 * 2
+    block = np.indices((factor, factor, factor)).reshape(3, -1).T
+    coords = (band_coords[:, None, :] * factor + block[None, :, :]).reshape(-1, 3) - origin + 1
+
+    occupied = np.zeros(tuple((band_coords.max(axis=0) + 1) * factor - origin + 2), dtype=np.bool_)
+    occupied[coords[:, 0], coords[:, 1], coords[:, 2]] = True
+    thinVoxels(occupied, max_iter, coords)
+
+    coords = coords[occupied[coords[:, 0], coords[:, 1], coords[:, 2]]] - 1 + origin
+    new_voxels[coords[:, 0], coords[:, 1], coords[:, 2]] = model.voxels[coords[:, 0] // factor, coords[:, 1] // factor, coords[:, 2] // factor]
+    return VoxelModel(new_voxels, model.materials, model.coords, model.resolution * factor)
+
 if __name__ == '__main__':
     app1 = qg.QApplication(sys.argv)
 
@@ -104,7 +329,10 @@ if __name__ == '__main__':
     print('Model Created')
 
     # Process Model
-    ditherResult = dither(result1, int(round(box_x/2)), use_full=False, y_error=1/3)
+    ditherResult, _ = dither(result1, int(round(box_x/2)), use_full=False, y_error=1/3)
+
+    # Thin at the dither resolution, then refine the centerline at 5x scale
+    centerline = thinMultiresolution(ditherResult.isolateMaterial(1), 5)
 
     # Scale result
     ditherResult = ditherResult.scale(5) # 15
@@ -118,6 +346,7 @@ if __name__ == '__main__':
 
     # Save result
     result1.saveVF('thin-test')
+    centerline.saveVF('thin-test-multires')
 
     # Create mesh
     ditherMesh = Mesh.fromVoxelModel(result1)
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import numpy as np
+from numba import njit, prange
+
+# Lookup table of deletable voxels for topology preserving curve thinning
+# Indexed by the occupancy of the 26 neighbors of a voxel (bit k set if the voxel at OFFSETS[k] is occupied),
+# with one bit per neighbor configuration (2^26 bits, 8 MB)
+# A voxel is deletable if it is simple and is not the end of a curve (exactly one neighbor)
+# Simple: the neighbors form one 26-connected component and the empty voxels of the 18-neighborhood
+# form one 6-connected component touching the voxel (Bertrand and Malandain 1994)
+# The table is generated on first use and stored next to this file, run this file to regenerate it
+
+TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thin_table.npy')
+
+OFFSETS = np.array([(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1) if (dx, dy, dz) != (0, 0, 0)], dtype=np.int64)
+
+_table = None
+
+def neighborMasks():
+    # Bit masks of the 26-adjacent neighbors, the 6-adjacent neighbors within the 18-neighborhood,
+    # the 18-neighborhood, and the 6-neighborhood
+    distance = np.abs(OFFSETS[:, None, :] - OFFSETS[None, :, :])
+    n18 = np.abs(OFFSETS).sum(axis=1) <= 2
+    faces = np.abs(OFFSETS).sum(axis=1) == 1
+    bits = (1 << np.arange(26, dtype=np.int64))
+
+    adjacent26 = (distance.max(axis=2) == 1)
+    adjacent6 = (distance.sum(axis=2) == 1) & n18[:, None] & n18[None, :]
+    return (adjacent26 * bits).sum(axis=1), (adjacent6 * bits).sum(axis=1), int(bits[n18].sum()), int(bits[faces].sum())
+
+@njit(cache=True)
+def countComponents(bits, adjacency, seeds):
+    # Number of components of bits (connected by adjacency) that contain a seed bit
+    count = 0
+    remaining = bits
+    for k in range(26):
+        if (seeds >> k) & 1 and (remaining >> k) & 1:
+            count += 1
+            component = np.int64(1) << k
+            frontier = component
+            while frontier != 0:
+                grown = np.int64(0)
+                for j in range(26):
+                    if (frontier >> j) & 1:
+                        grown |= adjacency[j]
+                frontier = grown & remaining & ~component
+                component |= frontier
+            remaining &= ~component
+    return count
+
+@njit(cache=True)
+def isDeletable(code, adjacent26, adjacent6, n18, faces):
+    if code & (code - 1) == 0:
+        return False    # Isolated voxel or end of a curve
+    if countComponents(code, adjacent26, code) != 1:
+        return False
+    return countComponents(~code & n18, adjacent6, faces) == 1
+
+@njit(parallel=True, cache=True)
+def buildTable(adjacent26, adjacent6, n18, faces):
+    table = np.zeros(2 ** 23, dtype=np.uint8)
+    for byte in prange(2 ** 23):
+        value = 0
+        for b in range(8):
+            if isDeletable(np.int64(byte * 8 + b), adjacent26, adjacent6, n18, faces):
+                value |= 1 << b
+        table[byte] = value
+    return table
+
+def generateTable():
+    return buildTable(*neighborMasks())
+
+def saveTable(table):
+    # Written to a temporary file unique to this process, so concurrent runs can generate the table at the same time
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(TABLE_FILE), prefix='thin_table.', suffix='.tmp.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, table)
+        os.replace(temp, TABLE_FILE)
+    except OSError:
+        # A concurrent run may have saved the table first
+        if not os.path.exists(TABLE_FILE):
+            raise
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def loadTable():
+    global _table
+    if _table is None:
+        if os.path.exists(TABLE_FILE):
+            _table = np.load(TABLE_FILE)
+        else:
+            print('Generating thinning table')
+            _table = generateTable()
+            saveTable(_table)
+    return _table
+
+def neighborCodes(occupied, coords):
+    # Table index of each voxel in coords, occupied must have at least one empty voxel of padding around coords
+    codes = np.zeros(len(coords), dtype=np.int64)
+    for k, (dx, dy, dz) in enumerate(OFFSETS):
+        codes |= occupied[coords[:, 0] + dx, coords[:, 1] + dy, coords[:, 2] + dz].astype(np.int64) << k
+    return codes
+
+def deletable(occupied, coords):
+    codes = neighborCodes(occupied, coords)
+    return ((loadTable()[codes >> 3] >> (codes & 7)) & 1).astype(np.bool_)
+
+if __name__ == '__main__':
+    table = generateTable()
+    saveTable(table)
+    print('Saved ' + TABLE_FILE)
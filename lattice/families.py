@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+from voxelfuse.voxel_model import VoxelModel
+from voxelfuse.periodic import gyroid, schwarzP, schwarzD, FRD
+
+# Persistent cache of dilated/eroded lattice element families
+# Families are keyed by the source (.vox file hash or TPMS parameters), the operation, and the radius range
+# Each family is stored as one flat voxel array (.npy, memory-mappable) plus a small .json header
+# The cache is limited to CACHE_SIZE bytes, least recently used families are removed first
+
+CACHE_FOLDER = os.environ.get('LATTICE_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'element_cache'))
+CACHE_SIZE = 2 ** 30
+CACHE_VERSION = 1
+
+def fileHash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def familyKey(source, operation, *params):
+    text = json.dumps([CACHE_VERSION, source, operation] + list(params))
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+def familyHeader(key, folder=CACHE_FOLDER):
+    header_file = os.path.join(folder, key + '.json')
+    if not os.path.exists(header_file):
+        return None
+    with open(header_file, 'r') as f:
+        return json.load(f)
+
+def loadFamily(key, folder=CACHE_FOLDER, mmap=True):
+    # With mmap, the voxel arrays are read-only views of the cache file
+    voxel_file = os.path.join(folder, key + '.npy')
+    header = familyHeader(key, folder)
+    if header is None or not os.path.exists(voxel_file):
+        return None
+
+    buffer = np.load(voxel_file, mmap_mode='r' if mmap else None)
+
+    resolutions = header.get('resolutions', [header['resolution']] * len(header['shapes']))
+
+    elements = []
+    start = 0
+    for shape, coords, materials, resolution in zip(header['shapes'], header['coords'], header['materials'], resolutions):
+        size = int(np.prod(shape))
+        voxels = buffer[start:start + size].reshape(shape)
+        elements.append(VoxelModel(voxels, np.array(materials, dtype=np.float32), tuple(coords), resolution))
+        start += size
+
+    # Mark as recently used
+    os.utime(voxel_file)
+    return elements
+
+def saveFamily(key, elements, folder=CACHE_FOLDER, max_size=CACHE_SIZE, info=None):
+    # info -- optional description stored in the header
+    os.makedirs(folder, exist_ok=True)
+
+    header = {
+        'shapes': [list(e.voxels.shape) for e in elements],
+        'coords': [[int(c) for c in e.coords] for e in elements],
+        'materials': [e.materials.tolist() for e in elements],
+        'resolution': elements[0].resolution if len(elements) > 0 else 1,
+        'resolutions': [e.resolution for e in elements],
+        'info': info,
+    }
+    dtype = np.result_type(np.uint16, *[e.voxels.dtype for e in elements])
+    buffer = np.concatenate([e.voxels.astype(dtype).ravel() for e in elements]) if len(elements) > 0 else np.zeros(0, dtype=dtype)
+
+    # Write to temporary files first so an interrupted run does not leave a partial family
+    # The temporary files are unique to this writer, so concurrent runs can save the same family
+    voxel_file = os.path.join(folder, key + '.npy')
+    header_file = os.path.join(folder, key + '.json')
+    voxel_fd, voxel_temp = tempfile.mkstemp(dir=folder, prefix=key + '.', suffix='.tmp.npy')
+    header_fd, header_temp = tempfile.mkstemp(dir=folder, prefix=key + '.', suffix='.json.tmp')
+    try:
+        with os.fdopen(voxel_fd, 'wb') as f:
+            np.save(f, buffer)
+        with os.fdopen(header_fd, 'w') as f:
+            json.dump(header, f)
+        os.replace(header_temp, header_file)
+        os.replace(voxel_temp, voxel_file)
+    except OSError:
+        # A concurrent writer may have finished the same family first (e.g. its file is open on Windows)
+        if not (os.path.exists(header_file) and os.path.exists(voxel_file)):
+            raise
+    finally:
+        for filename in (voxel_temp, header_temp):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    evictFamilies(folder, max_size, keep=key)
+
+def cacheEntries(folder=CACHE_FOLDER):
+    # (key, size in bytes, last used time), most recently used first
+    if not os.path.isdir(folder):
+        return []
+
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+            key = name[:-4]
+            voxel_file = os.path.join(folder, name)
+            header_file = os.path.join(folder, key + '.json')
+            size = os.path.getsize(voxel_file) + (os.path.getsize(header_file) if os.path.exists(header_file) else 0)
+            entries.append((key, size, os.path.getmtime(voxel_file)))
+    return sorted(entries, key=lambda e: -e[2])
+
+def removeFamily(key, folder=CACHE_FOLDER):
+    for ext in ('.npy', '.json'):
+        filename = os.path.join(folder, key + ext)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def evictFamilies(folder=CACHE_FOLDER, max_size=CACHE_SIZE, keep=None):
+    total = 0
+    for key, size, _ in cacheEntries(folder):
+        total += size
+        if total > max_size and key != keep:
+            removeFamily(key, folder)
+            total -= size
+
+def dilationSeries(model, min_radius, max_radius, bounded=False):
+    # Same as [model.dilate(r) for r in min_radius..max_radius] (or dilateBounded)
+    # Each level is one unit dilation of the previous level, instead of dilating the original model r times
+    series = []
+    current = model
+    for r in range(0, max_radius + 1):
+        if r > 0:
+            current = current.dilateBounded(1) if bounded else current.dilate(1)
+        if r >= min_radius:
+            series.append(current if r > 0 else VoxelModel.copy(model))
+    return series
+
+def cachedFamily(key, build, folder=CACHE_FOLDER):
+    elements = loadFamily(key, folder)
+    if elements is None:
+        elements = build()
+        saveFamily(key, elements, folder)
+    return elements
+
+def dilationFamily(voxFile, min_radius, max_radius, bounded=False, folder=CACHE_FOLDER, model=None):
+    # [dilate(r) for r in min_radius..max_radius] of the element in voxFile
+    # model -- the element already loaded from voxFile, to avoid reading it again on a cache miss
+    operation = 'dilateBounded' if bounded else 'dilate'
+
+    def build():
+        return dilationSeries(model if model is not None else VoxelModel.fromVoxFile(voxFile), min_radius, max_radius, bounded)
+
+    return cachedFamily(familyKey(fileHash(voxFile), operation, min_radius, max_radius), build, folder)
+
+def surfaceModels(surfaceType, s):
+    # Negative and positive halves of a TPMS cell, 1 - gyroid, 2 - p-surface, 3 - d-surface, 4 - FRD
+    if surfaceType == 2:
+        return schwarzP((s,s,s), s)
+    elif surfaceType == 3:
+        return schwarzD((s,s,s), s)
+    elif surfaceType == 4:
+        return FRD((s,s,s), s)
+    else: # surfaceType == 1
+        return gyroid((s,s,s), s)
+
+def surfaceFamily(surfaceType, s, max_erode, max_dilate, folder=CACHE_FOLDER):
+    # Eroded (difference with the dilated opposite half) and dilated copies of a TPMS cell, thinnest first
+    # Also returns the undilated negative half of the cell
+    def build():
+        lattice_model_1, lattice_model_2 = surfaceModels(surfaceType, s)
+        dilated_2 = dilationSeries(lattice_model_2, 1, max_erode)
+        elements = [lattice_model_1]
+        for r in range(0, max_erode):
+            elements.append(lattice_model_1.difference(dilated_2[max_erode - r - 1]))
+        elements.extend(dilationSeries(lattice_model_1, 0, max_dilate))
+        return elements
+
+    elements = cachedFamily(familyKey('tpms', 'erode-difference', surfaceType, s, max_erode, max_dilate), build, folder)
+    return elements[0], elements[1:]
+
+if __name__ == '__main__':
+    # python families.py [purge]
+    if len(sys.argv) > 1 and sys.argv[1] == 'purge':
+        for key, _, _ in cacheEntries():
+            removeFamily(key)
+        print('Removed all element families from ' + CACHE_FOLDER)
+    else:
+        entries = cacheEntries()
+        for key, size, _ in entries:
+            print('%s %10.1f MB' % (key, size / 2 ** 20))
+        print('%d families, %.1f MB in %s' % (len(entries), sum(e[1] for e in entries) / 2 ** 20, CACHE_FOLDER))
@@ -0,0 +1,123 @@
+import numpy as np
+from numba import njit
+
+from voxelfuse.voxel_model import VoxelModel
+
+# Place lattice elements on a grid of cells in a single preallocated array
+# Equivalent to setting elements[r].coords for each cell and combining the results with union(), followed by setMaterial()
+
+MIXED = 0
+EMPTY = 1
+SOLID = 2
+
+def paletteDensity(model):
+    # Lattice density of each palette entry, occupancy times the fraction of material that is not null
+    materials = model.materials
+    return materials[:, 0] * (1 - materials[:, 1])
+
+def latticeDensity(model):
+    # Per-voxel lattice density of a processed model
+    return paletteDensity(model)[model.voxels]
+
+def elementIndex(model, n_elements, solid_ends=True):
+    # Convert a processed model to a grid of element indices, with a histogram of how often each element is used
+    # Density is computed once per palette entry and gathered through the voxels
+    density = paletteDensity(model)
+
+    if solid_ends:
+        # First element is empty, last element is solid, the rest are graded by density
+        palette_index = np.rint(density * (n_elements - 3)) + 1
+        palette_index[density < 1e-10] = 0
+        palette_index[density > (1 - 1e-10)] = n_elements - 1
+    else:
+        palette_index = np.minimum(np.floor(density * n_elements), n_elements - 1)
+
+    index = palette_index.astype(np.int32)[model.voxels]
+    histogram = np.bincount(index.ravel(), minlength=n_elements)
+    return index, histogram
+
+def packElements(elements, cell_size, histogram=None):
+    # Flatten the element occupancy masks into one buffer so they can be indexed from a compiled loop
+    # Elements that are unused (according to histogram), empty, or completely solid are not stored
+    shapes = np.array([e.voxels.shape for e in elements], dtype=np.int64)
+    kinds = np.full(len(elements), MIXED, dtype=np.int8)
+    masks = []
+    for r, e in enumerate(elements):
+        if histogram is not None and histogram[r] == 0:
+            kinds[r] = EMPTY
+            masks.append(np.zeros(0, dtype=np.uint8))
+            continue
+
+        mask = (e.voxels != 0).ravel()
+        if not mask.any():
+            kinds[r] = EMPTY
+        elif mask.all():
+            kinds[r] = SOLID
+        else:
+            masks.append(mask.astype(np.uint8))
+            continue
+        masks.append(np.zeros(0, dtype=np.uint8))
+
+    sizes = np.array([len(m) for m in masks], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+    buffer = np.concatenate(masks)
+
+    # Elements larger than a cell (e.g. dilated elements) are centered on the cell and overlap their neighbors
+    offsets = np.array([round((e.voxels.shape[0] - cell_size) / 2) for e in elements], dtype=np.int64)
+
+    return buffer, shapes, starts, offsets, kinds
+
+@njit(cache=True)
+def tileKernel(out, origin, element_index, cell_size, buffer, shapes, starts, offsets, kinds):
+    box_x, box_y, box_z = element_index.shape
+
+    for cx in range(box_x):
+        for cy in range(box_y):
+            for cz in range(box_z):
+                r = element_index[cx, cy, cz]
+                if r < 0 or kinds[r] == EMPTY:
+                    continue
+
+                x0 = cx * cell_size - offsets[r] - origin[0]
+                y0 = cy * cell_size - offsets[r] - origin[1]
+                z0 = cz * cell_size - offsets[r] - origin[2]
+                x_len = shapes[r, 0]
+                y_len = shapes[r, 1]
+                z_len = shapes[r, 2]
+                start = starts[r]
+
+                if kinds[r] == SOLID:
+                    out[x0:x0 + x_len, y0:y0 + y_len, z0:z0 + z_len] = 1
+                    continue
+
+                # Overlapping elements are combined with a max reduction
+                for x in range(x_len):
+                    for y in range(y_len):
+                        i = start + (x * y_len + y) * z_len
+                        for z in range(z_len):
+                            if buffer[i + z] > out[x0 + x, y0 + y, z0 + z]:
+                                out[x0 + x, y0 + y, z0 + z] = buffer[i + z]
+
+def tileLattice(element_index, elements, cell_size, material=1, resolution=1, histogram=None):
+    # element_index -- (boxX, boxY, boxZ) array of indices into elements, cells set to -1 are left empty
+    # elements -- list of VoxelModels, placed at (cell * cell_size) - offset
+    # histogram -- element usage counts from elementIndex, unused elements are skipped
+    element_index = np.asarray(element_index, dtype=np.int64)
+    cell_size = int(cell_size)
+    buffer, shapes, starts, offsets, kinds = packElements(elements, cell_size, histogram)
+
+    # Output bounds cover every placed element, including empty ones (as union() does)
+    cells = np.argwhere(element_index >= 0)
+    if len(cells) == 0:
+        return VoxelModel(np.zeros((1, 1, 1), dtype=np.uint16), material, resolution=resolution)
+
+    r = element_index[cells[:, 0], cells[:, 1], cells[:, 2]]
+    low = cells * cell_size - offsets[r, None]
+    high = low + shapes[r]
+    origin = low.min(axis=0)
+    size = high.max(axis=0) - origin
+
+    out = np.zeros(tuple(size), dtype=np.uint16)
+    tileKernel(out, origin, element_index, cell_size, buffer, shapes, starts, offsets, kinds)
+
+    return VoxelModel(out, material, tuple(int(c) for c in origin), resolution)
@@ -0,0 +1,52 @@
+import numpy as np
+
+# Graded TPMS lattices evaluated directly from the implicit surface functions
+# Uses the same functions as voxelfuse.periodic, material is placed where f(x, y, z) < threshold
+# The threshold varies per voxel so that the local volume fraction matches a target density field
+
+def surfaceFunction(surfaceType, x, y, z):
+    # 1 - gyroid, 2 - p-surface, 3 - d-surface, 4 - FRD, coordinates in radians (broadcast together)
+    if surfaceType == 2:
+        return np.cos(x) + np.cos(y) + np.cos(z)
+    elif surfaceType == 3:
+        sx, sy, sz = np.sin(x), np.sin(y), np.sin(z)
+        cx, cy, cz = np.cos(x), np.cos(y), np.cos(z)
+        return sx*sy*sz + sx*cy*cz + cx*sy*cz + cx*cy*sz
+    elif surfaceType == 4:
+        c2x, c2y, c2z = np.cos(2*x), np.cos(2*y), np.cos(2*z)
+        return 4*np.cos(x)*np.cos(y)*np.cos(z) - c2x*c2y - c2y*c2z - c2x*c2z
+    else: # surfaceType == 1
+        return np.sin(x)*np.cos(y) + np.sin(y)*np.cos(z) + np.sin(z)*np.cos(x)
+
+def surfaceLevels(surfaceType, samples=64):
+    # Sorted function values over one period, the threshold for density d is the d quantile
+    t = np.arange(samples) * (2*np.pi / samples)
+    f = surfaceFunction(surfaceType, t[:, None, None], t[None, :, None], t[None, None, :])
+    return np.sort(f.ravel())
+
+def densityThreshold(levels, density):
+    # Threshold giving a volume fraction of density, empty at 0 and solid at 1
+    quantiles = (np.arange(len(levels)) + 0.5) / len(levels)
+    threshold = np.interp(density, quantiles, levels)
+    threshold[density <= 0] = -np.inf
+    threshold[density >= 1] = np.inf
+    return threshold
+
+def gradedSurface(density, surfaceType, period, coords=(0, 0, 0), chunk_size=16, samples=64):
+    # density -- (x, y, z) array of target volume fractions
+    # period -- size of one cell in voxels, coords -- position of density[0, 0, 0] so neighboring regions line up
+    # Evaluated in slabs of chunk_size along x to limit the size of the temporary arrays
+    density = np.asarray(density, dtype=np.float32)
+    levels = surfaceLevels(surfaceType, samples)
+    s = 2*np.pi / period
+
+    x_len, y_len, z_len = density.shape
+    y = ((np.arange(y_len) + coords[1]) * s)[None, :, None]
+    z = ((np.arange(z_len) + coords[2]) * s)[None, None, :]
+
+    out = np.zeros(density.shape, dtype=np.uint16)
+    for x0 in range(0, x_len, chunk_size):
+        x1 = min(x0 + chunk_size, x_len)
+        x = ((np.arange(x0, x1) + coords[0]) * s)[:, None, None]
+        out[x0:x1] = surfaceFunction(surfaceType, x, y, z) < densityThreshold(levels, density[x0:x1])
+    return out
@@ -11,6 +11,8 @@ from voxelfuse.voxel_model import VoxelModel
 from voxelfuse.mesh import Mesh
 from voxelfuse.plot import Plot
 
+from lattice.families import dilationFamily
+
 # Start Application
 if __name__=='__main__':
     app1 = qg.QApplication(sys.argv)
@@ -25,9 +27,9 @@ if __name__=='__main__':
     start = time.time()
 
     # Process Model
-    modelResult = VoxelModel.copy(latticeModel)
-    modelResult1 = modelResult.dilateBounded(min_radius)
-    modelResult2 = modelResult.dilateBounded(max_radius)
+    family = dilationFamily('lattice_element_1m.vox', min_radius, max_radius, bounded=True, model=latticeModel)
+    modelResult1 = family[0]
+    modelResult2 = family[-1]
 
     end = time.time()
     m1Time = (end - start)
@@ -7,36 +7,18 @@ Dan Aukes, Cole Brauer
 import PyQt5.QtGui as qg
 import sys
 import time
-from tqdm import tqdm
 from voxelfuse.voxel_model import VoxelModel
 from voxelfuse.mesh import Mesh
 from voxelfuse.plot import Plot
 from voxelfuse.primitives import *
 
-# Start Application
-if __name__=='__main__':
-    app1 = qg.QApplication(sys.argv)
-
-    lattice_element_file = 'lattice_element_1m'
-    min_radius = 1  # min radius that results in a printable structure    (1,  7)
-    max_radius = 4  # max radius that results in a viable lattice element (6, 25)
-
-    mold = True
-    moldWallThickness = 5
-    moldGap = 2
-
-    save = False  # VF file for reopening
-    export = False # STL file for slicing
-    display = True # Show result in viewer
-
-    box_x = 10
-    box_y = 2
-    box_z = 2
-
-    start = time.time()
+from dithering.blur import blurModel
+from lattice.families import dilationFamily
+from lattice.tiling import elementIndex, tileLattice
 
+def latticeTransition(latticeElementFile, box_x, box_y, box_z, min_radius, max_radius):
     # Import Models
-    latticeModel = VoxelModel.fromVoxFile(lattice_element_file + '.vox')
+    latticeModel = VoxelModel.fromVoxFile(latticeElementFile)
     lattice_size = latticeModel.voxels.shape[0]
     print('Lattice Element Imported')
 
@@ -47,38 +29,45 @@ if __name__=='__main__':
     print('Model Created')
 
     # Process Models
-    modelResult = baseModel.blur(int(round(box_x/6)))
-    modelResult = modelResult.scaleValues()
+    modelResult = blurModel(baseModel, int(round(box_x/6)), scale=True)
     modelResult = modelResult - modelResult.setMaterial(3)
     modelResult = modelResult.scaleNull()
     print('Model Processed')
 
     # Generate Dilated Lattice Elements
     latticeElements = [VoxelModel.emptyLike(latticeModel)]
-    for r in range(min_radius, max_radius+1):
-        latticeElements.append(latticeModel.dilateBounded(r))
+    latticeElements.extend(dilationFamily(latticeElementFile, min_radius, max_radius, bounded=True, model=latticeModel))
     latticeElements.append(cuboid(latticeModel.voxels.shape))
     print('Lattice Elements Generated')
 
     # Convert processed model to lattice
-    latticeResult = VoxelModel.emptyLike(baseModel)
+    elementIndexGrid, histogram = elementIndex(modelResult, len(latticeElements), solid_ends=False)
+
+    return tileLattice(elementIndexGrid[:box_x * 2, :box_y, :box_z], latticeElements, lattice_size, material=1, resolution=baseModel.resolution, histogram=histogram)
+
+# Start Application
+if __name__=='__main__':
+    app1 = qg.QApplication(sys.argv)
+
+    lattice_element_file = 'lattice_element_1m'
+    min_radius = 1  # min radius that results in a printable structure    (1,  7)
+    max_radius = 4  # max radius that results in a viable lattice element (6, 25)
 
-    for x in tqdm(range(box_x * 2), desc='Adding lattice elements'):
-        for y in range(box_y):
-            for z in range(box_z):
-                i = modelResult.voxels[x, y, z]
-                density =  modelResult.materials[i, 0] * (1 - modelResult.materials[i, 1])
-                r = min(int(density * len(latticeElements)), len(latticeElements) - 1)
+    mold = True
+    moldWallThickness = 5
+    moldGap = 2
 
-                x_new = x * lattice_size
-                y_new = y * lattice_size
-                z_new = z * lattice_size
+    save = False  # VF file for reopening
+    export = False # STL file for slicing
+    display = True # Show result in viewer
 
-                latticeElements[r].coords = (x_new, y_new, z_new)
+    box_x = 10
+    box_y = 2
+    box_z = 2
 
-                latticeResult = latticeResult.union(latticeElements[r])
+    start = time.time()
 
-    latticeResult = latticeResult.setMaterial(1)
+    latticeResult = latticeTransition(lattice_element_file + '.vox', box_x, box_y, box_z, min_radius, max_radius)
     print('Lattice Structure Created')
 
     # Generate Resin Component
@@ -0,0 +1,253 @@
+import os
+import sys
+import glob
+import time
+import queue
+import json
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+
+import numpy as np
+
+# Headless benchmark suite for the coupon patterns and the analysis scripts
+# Each case runs in a fresh process, records wall time, CPU time and peak RSS, and hashes its output
+# Output hashes are compared against output_hashes.json, which is committed with the code
+# Time and memory are compared against baselines.json, which is local to each machine
+# Run with --update to record new hashes and baselines, a case without a stored hash fails
+# The contact area and volume ratio cases read .vf files with VoxelModel.openVF, which needs numpy < 2
+#
+#   python benchmark.py                      # run everything and compare to the stored hashes and baselines
+#   python benchmark.py --only coupon/C      # run cases whose name contains a string
+#   python benchmark.py --res 2 3 5 --update # record baselines at several resolutions
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(REPO_FOLDER, 'profiling', 'baselines.json')
+HASH_FILE = os.path.join(REPO_FOLDER, 'profiling', 'output_hashes.json')
+CASE_TIMEOUT = 4 * 3600 # seconds
+
+COUPON_CONFIGS = ['A', 'B1', 'B2', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'LA', 'LC', 'LD', 'LE', 'LF', 'LG', 'LH', 'LI', 'LJ', 'LK']
+RESOLUTIONS = [3, 5]  # voxels per mm
+
+@contextmanager
+def workingDirectory(folder):
+    # The scripts load their input files relative to their own folder
+    previous = os.getcwd()
+    os.chdir(os.path.join(REPO_FOLDER, folder))
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def modelHash(model):
+    # Hash the geometry and materials independent of palette order
+    from dithering.indexing import reindexMaterials
+    voxels, materials = reindexMaterials(model.voxels.astype(np.int32), model.materials)
+    h = hashlib.sha256()
+    h.update(np.array(voxels.shape, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(voxels, dtype=np.int32).tobytes())
+    h.update(np.round(materials, 6).astype(np.float32).tobytes())
+    return h.hexdigest()[:16]
+
+def valueHash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=float).encode()).hexdigest()[:16]
+
+def benchCoupon(configID, res):
+    import strength_test_coupon.strength_test_coupon_mm3dp_V2 as coupon_script
+    from strength_test_coupon.strength_test_coupon_mm3dp_V2 import loadConfig, generateCoupon
+    coupon_script.stageCache = False # Always run every stage
+    with workingDirectory('strength_test_coupon'):
+        config = loadConfig(configID)
+        config['res'] = res
+        return modelHash(generateCoupon(config))
+
+def benchThin(voxFile, max_iter):
+    from voxelfuse.voxel_model import VoxelModel
+    from dithering.thin import thin
+    with workingDirectory('dithering'):
+        model = VoxelModel.fromVoxFile(voxFile)
+        return modelHash(thin(model, max_iter))
+
+def benchLattice(elementFile, box_x, box_y, box_z, min_radius, max_radius):
+    from lattice_transition.lattice_transition import latticeTransition
+    with workingDirectory('lattice_transition'):
+        return modelHash(latticeTransition(elementFile + '.vox', box_x, box_y, box_z, min_radius, max_radius))
+
+def benchContactArea(vfFile, transitionWidth=12, transitionCenter=71.1, materialToMeasure=1):
+    from voxelfuse.voxel_model import VoxelModel
+    from strength_test_coupon.contact_area import contactArea
+    with workingDirectory('strength_test_coupon'):
+        model = VoxelModel.openVF(vfFile)
+        model.resolution = 5 # Resolution is not set in the committed files
+        totalSurfaceCount, _, _ = contactArea(model, transitionWidth, transitionCenter, materialToMeasure)
+        return valueHash(int(totalSurfaceCount))
+
+def benchVolumeRatio(vfFiles, rigidMaterial=2, flexibleMaterial=1):
+    from voxelfuse.voxel_model import VoxelModel
+    from strength_test_coupon.material_volume_ratio import volumeRatio
+    with workingDirectory('strength_test_coupon'):
+        ratios = []
+        for vfFile in vfFiles:
+            model = VoxelModel.openVF(vfFile)
+            model.resolution = 5
+            ratios.append([round(float(r), 9) for r in volumeRatio(model, rigidMaterial, flexibleMaterial)])
+        return valueHash(ratios)
+
+def benchmarkCases(configIDs=COUPON_CONFIGS, resolutions=RESOLUTIONS):
+    # (name, function, args)
+    cases = []
+    for configID in configIDs:
+        for res in resolutions:
+            cases.append(('coupon/' + configID + '@res' + str(res), benchCoupon, (configID, res)))
+
+    cases.append(('thin/centerline-test', benchThin, ('centerline-test.vox', 50)))
+    cases.append(('lattice/lattice_element_1m_20x2x2', benchLattice, ('lattice_element_1m', 10, 2, 2, 1, 4)))
+
+    vfFiles = sorted(glob.glob(os.path.join(REPO_FOLDER, 'strength_test_coupon', 'stl_files_*', 'output_*.vf')))
+    vfFiles = [os.path.relpath(f, os.path.join(REPO_FOLDER, 'strength_test_coupon'))[:-3] for f in vfFiles]
+    for vfFile in vfFiles:
+        cases.append(('contact_area/' + vfFile, benchContactArea, (vfFile,)))
+    cases.append(('volume_ratio/all', benchVolumeRatio, (vfFiles,)))
+
+    return cases
+
+def runCase(name, function, args):
+    from profiling.tracing import Tracer, span
+
+    with Tracer(name, trace_malloc=False):
+        with span('run') as s:
+            output_hash = function(*args)
+
+    return {
+        'wall': s['wall'],
+        'cpu': s['cpu'],
+        'peak_rss': s['rss_peak'],
+        'rss_growth': s['rss_peak'] - s['rss_start'],
+        'hash': output_hash,
+    }
+
+def _runChild(name, function, args, results):
+    # Silence the progress bars and prints of the scripts
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        results.put(runCase(name, function, args))
+    except Exception:
+        results.put({'error': traceback.format_exc().strip().splitlines()[-1]})
+
+def runIsolated(name, function, args, timeout=CASE_TIMEOUT):
+    # A child that crashes or is killed is reported as failed instead of waiting for its result forever
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_runChild, args=(name, function, args, results))
+    process.start()
+
+    start = time.perf_counter()
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    result = {'error': 'process exited with code ' + str(process.exitcode)}
+            elif timeout is not None and time.perf_counter() - start > timeout:
+                process.terminate()
+                result = {'error': 'timed out after %d s' % timeout}
+
+    process.join()
+    return result
+
+def compare(result, baseline, expected_hash, threshold):
+    # Returns a list of flags, empty when the output matches and the result is within the threshold of the baseline
+    # A case without a stored hash fails, new cases are recorded with --update
+    if 'error' in result:
+        return ['ERROR']
+
+    flags = []
+    if expected_hash is None:
+        flags.append('NO HASH')
+    elif result['hash'] != expected_hash:
+        flags.append('OUTPUT CHANGED')
+    if baseline is None:
+        return flags
+    if result['wall'] > baseline['wall'] * (1 + threshold):
+        flags.append('SLOWER')
+    if result['peak_rss'] > baseline['peak_rss'] * (1 + threshold):
+        flags.append('MORE MEMORY')
+    return flags
+
+def loadBaselines(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def saveBaselines(filename, baselines):
+    with open(filename, 'w') as f:
+        json.dump(baselines, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmark suite and compare against stored baselines')
+    parser.add_argument('--configs', nargs='+', default=COUPON_CONFIGS, help='coupon config IDs')
+    parser.add_argument('--res', nargs='+', type=int, default=RESOLUTIONS, help='coupon resolutions (voxels per mm)')
+    parser.add_argument('--only', nargs='+', default=None, help='only run cases whose name contains one of these strings')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed fractional increase in time and peak memory')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='time and memory baseline file')
+    parser.add_argument('--hashes', default=HASH_FILE, help='output hash file')
+    parser.add_argument('--update', action='store_true', help='store the results as the new baseline and output hashes')
+    parser.add_argument('--timeout', type=float, default=CASE_TIMEOUT, help='seconds before a case is stopped and reported as failed')
+    parser.add_argument('--output', default=None, help='save results to a JSON file')
+    parser.add_argument('--no-isolate', action='store_true', help='run all cases in this process')
+    options = parser.parse_args()
+
+    if REPO_FOLDER not in sys.path:
+        sys.path.insert(0, REPO_FOLDER)
+
+    cases = benchmarkCases(options.configs, options.res)
+    if options.only is not None:
+        cases = [c for c in cases if any(s in c[0] for s in options.only)]
+
+    baselines = loadBaselines(options.baseline)
+    hashes = loadBaselines(options.hashes)
+    results = {}
+    regressions = 0
+
+    print('%-48s %10s %10s %12s %18s  %s' % ('Case', 'Wall (s)', 'Base (s)', 'Peak RSS MB', 'Hash', 'Status'))
+    for name, function, args in cases:
+        if options.no_isolate:
+            try:
+                result = runCase(name, function, args)
+            except Exception:
+                result = {'error': traceback.format_exc().strip().splitlines()[-1]}
+        else:
+            result = runIsolated(name, function, args, options.timeout)
+
+        results[name] = result
+        baseline = baselines.get(name)
+        flags = compare(result, baseline, hashes.get(name), options.threshold)
+        if flags:
+            regressions += 1
+
+        if 'error' in result:
+            print('%-48s %10s %10s %12s %18s  %s' % (name, '-', '-', '-', '-', 'ERROR ' + result['error']))
+        else:
+            base_wall = '%10.2f' % baseline['wall'] if baseline is not None else '%10s' % '-'
+            print('%-48s %10.2f %s %12.1f %18s  %s' % (name, result['wall'], base_wall, result['peak_rss'], result['hash'], ', '.join(flags) if flags else 'ok'))
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if options.update:
+        baselines.update({name: result for name, result in results.items() if 'error' not in result})
+        saveBaselines(options.baseline, baselines)
+        hashes.update({name: result['hash'] for name, result in results.items() if 'error' not in result})
+        saveBaselines(options.hashes, hashes)
+        print('Baselines saved to ' + options.baseline + ', output hashes saved to ' + options.hashes)
+    elif regressions > 0:
+        print(str(regressions) + ' case(s) regressed, failed or have no stored hash (run with --update to record new cases)')
+        sys.exit(1)
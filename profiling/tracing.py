@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Stage-level tracing for the coupon and dither pipelines
+# Spans record wall time, CPU time, peak RSS (from a background sampler) and tracemalloc deltas
+#
+#   with Tracer('A') as tracer:
+#       with span('dither'):
+#           ...
+#   tracer.save('profile_A.json')
+#   tracer.saveChromeTrace('profile_A_chrome.json')  # open in chrome://tracing or ui.perfetto.dev
+#
+# Run this file with saved trace files as arguments to print a summary
+
+MB = float(2 ** 20)
+
+# Stack of running tracers, spans are recorded on the most recent one
+_active = []
+
+class Tracer:
+    def __init__(self, name='', sample_interval=0.01, trace_malloc=True):
+        self.name = name
+        self.sample_interval = sample_interval  # s between RSS samples
+        self.trace_malloc = trace_malloc        # tracemalloc adds overhead to pure Python code
+        self.spans = []
+        self.samples = []
+
+        self._open = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._process = None
+        self._stop_malloc = False
+        self._start = 0.0
+
+    def __enter__(self):
+        import psutil
+        self._process = psutil.Process(os.getpid())
+        self._start = time.perf_counter()
+
+        if self.trace_malloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._stop_malloc = True
+
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        _active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _active.remove(self)
+        self._stop.set()
+        self._sampler.join()
+
+        if self._stop_malloc:
+            tracemalloc.stop()
+            self._stop_malloc = False
+        return False
+
+    def _rss(self):
+        # Record an RSS sample and update the peak of every open span
+        rss = self._process.memory_info().rss / MB
+        with self._lock:
+            self.samples.append((time.perf_counter() - self._start, rss))
+            for s in self._open:
+                s['rss_peak'] = max(s['rss_peak'], rss)
+        return rss
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            self._rss()
+
+    def _mallocPeak(self):
+        # tracemalloc only keeps one global peak, fold it into the open spans before it is reset
+        if not tracemalloc.is_tracing():
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            for s in self._open:
+                s['malloc_peak'] = max(s['malloc_peak'], peak / MB - s['malloc_start'])
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def span(self, name, **args):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        self._mallocPeak()
+        malloc_start = tracemalloc.get_traced_memory()[0] / MB if tracemalloc.is_tracing() else 0.0
+        rss_start = self._rss()
+
+        s = {
+            'name': name,
+            'path': stack[-1]['path'] + '/' + name if stack else name,
+            'depth': len(stack),
+            'tid': threading.get_ident(),
+            'args': args,
+            'start': time.perf_counter() - self._start,
+            'wall': 0.0,
+            'cpu': 0.0,
+            'rss_start': rss_start,
+            'rss_end': rss_start,
+            'rss_peak': rss_start,
+            'malloc_start': malloc_start,
+            'malloc_delta': 0.0,
+            'malloc_peak': 0.0,
+        }
+        stack.append(s)
+        with self._lock:
+            self._open.append(s)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield s
+        finally:
+            s['cpu'] = time.process_time() - cpu_start
+            s['wall'] = time.perf_counter() - wall_start
+
+            self._mallocPeak()
+            if tracemalloc.is_tracing():
+                s['malloc_delta'] = tracemalloc.get_traced_memory()[0] / MB - malloc_start
+            s['rss_end'] = self._rss()
+
+            stack.pop()
+            with self._lock:
+                self._open.remove(s)
+                self.spans.append(s)
+
+    def merge(self, trace):
+        # Add the spans of a trace recorded in another process (from toDict), nested under the current span of this thread
+        stack = getattr(self._local, 'stack', None) or []
+        parent = stack[-1] if stack else None
+        offset = trace['clock_start'] - self._start
+
+        with self._lock:
+            for s in trace['spans']:
+                s = dict(s)
+                s['start'] += offset
+                s.setdefault('pid', trace['pid'])
+                if parent is not None:
+                    s['path'] = parent['path'] + '/' + s['path']
+                    s['depth'] += parent['depth'] + 1
+                self.spans.append(s)
+
+    def toDict(self):
+        # Times in s, memory in MB
+        return {
+            'name': self.name,
+            'trace_malloc': self.trace_malloc,
+            'pid': os.getpid(),
+            'clock_start': self._start,
+            'spans': sorted(self.spans, key=lambda s: s['start']),
+            'rss_samples': self.samples,
+        }
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.toDict(), f, indent=1, default=str)
+
+    def saveChromeTrace(self, filename):
+        saveChromeTrace(self.toDict(), filename)
+
+    def summary(self):
+        printSummary(self.toDict())
+
+def span(name, **args):
+    # Record a span on the active tracer, does nothing when no tracer is running
+    if not _active:
+        return nullcontext()
+    return _active[-1].span(name, **args)
+
+def activeTracer():
+    return _active[-1] if _active else None
+
+def merge(trace):
+    # Add the spans of a trace from another process to the active tracer
+    if _active and trace is not None:
+        _active[-1].merge(trace)
+
+def _afterFork():
+    # The sampler thread does not exist in a forked child, spans there are only recorded by a new Tracer
+    del _active[:]
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+def saveChromeTrace(trace, filename):
+    # Chrome trace event format, complete events for spans and a counter track for RSS
+    pid = os.getpid()
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': trace['name']}}]
+
+    for s in trace['spans']:
+        args = dict(s['args'])
+        for key in ('cpu', 'rss_start', 'rss_end', 'rss_peak', 'malloc_delta', 'malloc_peak'):
+            args[key] = round(s[key], 3)
+        events.append({'name': s['name'], 'ph': 'X', 'pid': s.get('pid', pid), 'tid': s['tid'], 'ts': s['start'] * 1e6, 'dur': s['wall'] * 1e6, 'args': args})
+
+    for t, rss in trace['rss_samples']:
+        events.append({'name': 'RSS (MB)', 'ph': 'C', 'pid': pid, 'ts': t * 1e6, 'args': {'rss': round(rss, 3)}})
+
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+def printSummary(trace):
+    # Totals per span path, in order of first appearance
+    totals = {}
+    for s in sorted(trace['spans'], key=lambda s: s['start']):
+        t = totals.setdefault(s['path'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'rss_peak': 0.0, 'malloc_peak': 0.0})
+        t['count'] += 1
+        t['wall'] += s['wall']
+        t['cpu'] += s['cpu']
+        t['rss_peak'] = max(t['rss_peak'], s['rss_peak'])
+        t['malloc_peak'] = max(t['malloc_peak'], s['malloc_peak'])
+
+    print('Trace: ' + str(trace['name']))
+    print('%-40s %6s %10s %10s %12s %14s' % ('Span', 'Count', 'Wall (s)', 'CPU (s)', 'Peak RSS MB', 'Peak alloc MB'))
+    for path, t in totals.items():
+        names = path.split('/')
+        print('%-40s %6d %10.3f %10.3f %12.1f %14.1f' % (('  ' * (len(names) - 1) + names[-1])[:40], t['count'], t['wall'], t['cpu'], t['rss_peak'], t['malloc_peak']))
+
+if __name__ == '__main__':
+    for traceFile in sys.argv[1:]:
+        with open(traceFile, 'r') as f:
+            printSummary(json.load(f))
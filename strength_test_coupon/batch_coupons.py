@@ -0,0 +1,101 @@
+"""
+Copyright 2020
+Dan Aukes, Cole Brauer
+
+Generate coupons for several configs in parallel
+
+Each distinct (couponStandard, res) template is voxelized once and shared with the worker processes
+Settings for saving, exporting and profiling are taken from strength_test_coupon_mm3dp_V2.py
+Run as a module from the repository folder, so it imports the coupon script the same way as the other packages
+
+  python -m strength_test_coupon.batch_coupons A B1 B2 C D E F G H I J K
+  python -m strength_test_coupon.batch_coupons --processes 4
+"""
+
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+
+from strength_test_coupon.strength_test_coupon_mm3dp_V2 import configIDs, loadConfig, voxelizeTemplates, runConfig
+
+# Voxelized templates, set in each worker by initWorker
+templates = {}
+
+def initWorker(sharedTemplates):
+    # With fork, the templates are inherited from the parent process instead of being copied
+    global templates
+    templates = sharedTemplates
+
+def buildConfig(configID):
+    # Silence the progress bars of the workers, the batch prints its own summary
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        config, _, timing = runConfig(configID, templates)
+        timing['filename'] = config.get('filename')
+    except Exception:
+        timing = {'error': traceback.format_exc().strip().splitlines()[-1]}
+    return configID, timing
+
+def voxelizeAll(configs):
+    # Voxelize each distinct template once
+    shared = {}
+    for configID in configs:
+        config = loadConfig(configID)
+        key = (config.get('couponStandard'), config.get('res'))
+        if key not in shared:
+            print('Voxelizing ' + key[0] + ' at res ' + str(key[1]))
+            shared[key] = voxelizeTemplates(*key)
+    return shared
+
+def runBatch(configs, processes=None):
+    start = time.perf_counter()
+    shared = voxelizeAll(configs)
+    voxelizeTime = time.perf_counter() - start
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(configs)))
+
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    ctx = multiprocessing.get_context(method)
+
+    # One coupon per worker process, so memory is returned after each config
+    timings = {}
+    with ctx.Pool(processes, initializer=initWorker, initargs=(shared,), maxtasksperchild=1) as pool:
+        for configID, timing in pool.imap_unordered(buildConfig, configs):
+            timings[configID] = timing
+            if 'error' in timing:
+                print('%-6s failed: %s' % (configID, timing['error']))
+            else:
+                print('%-6s done in %.1f s' % (configID, timing['wall']))
+
+    return timings, voxelizeTime, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate coupons for several configs in parallel')
+    parser.add_argument('configs', nargs='*', default=configIDs, help='config IDs (default: configIDs in strength_test_coupon_mm3dp_V2.py)')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    options = parser.parse_args()
+
+    # Config, template and output paths are relative to this folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    timings, voxelizeTime, totalTime = runBatch(options.configs, options.processes)
+
+    print('%-6s %-12s %10s %10s  %s' % ('Config', 'Filename', 'Wall (s)', 'CPU (s)', 'Status'))
+    for configID in options.configs:
+        timing = timings[configID]
+        if 'error' in timing:
+            print('%-6s %-12s %10s %10s  %s' % (configID, '-', '-', '-', 'ERROR ' + timing['error']))
+        else:
+            print('%-6s %-12s %10.1f %10.1f  %s' % (configID, timing['filename'], timing['wall'], timing['cpu'], 'ok'))
+
+    completed = [t['wall'] for t in timings.values() if 'error' not in t]
+    print('Template voxelization: %.1f s' % voxelizeTime)
+    if completed:
+        print('Slowest config: %.1f s, sum of configs: %.1f s' % (max(completed), sum(completed)))
+    print('Total: %.1f s' % totalTime)
+    print('Finished')
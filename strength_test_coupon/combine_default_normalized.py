@@ -11,6 +11,8 @@ from voxelfuse.mesh import Mesh
 from voxelfuse.plot import Plot
 from voxelfuse.primitives import *
 
+from dithering.indexing import removeDuplicateMaterials
+
 # Start Application
 if __name__=='__main__':
     app1 = qg.QApplication(sys.argv)
@@ -70,7 +72,7 @@ if __name__=='__main__':
     resultModel = resultModel.difference(marker3.setCoords((1400 + clearance + markerSize, 650 - clearance + markerSize, 0)))
 
     # Clean up
-    resultModel = resultModel.removeDuplicateMaterials()
+    resultModel = removeDuplicateMaterials(resultModel)
 
     # Create stl files
     for m in range(1, len(resultModel.materials)):
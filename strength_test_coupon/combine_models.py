@@ -11,6 +11,8 @@ from voxelfuse.mesh import Mesh
 from voxelfuse.plot import Plot
 from voxelfuse.primitives import *
 
+from dithering.indexing import removeDuplicateMaterials
+
 # Start Application
 if __name__=='__main__':
     app1 = qg.QApplication(sys.argv)
@@ -37,7 +39,7 @@ if __name__=='__main__':
     # Cleanup operations
     if cleanup:
         model.materials = np.round(model.materials, 1)
-        model = model.removeDuplicateMaterials()
+        model = removeDuplicateMaterials(model)
         model.saveVF(outputFolder + outputFile)
 
     # Create stl files
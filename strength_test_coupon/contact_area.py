@@ -19,23 +19,10 @@ from voxelfuse.primitives import *
 from voxelfuse.mesh import Mesh
 from voxelfuse.plot import Plot
 
-# Start Application
-if __name__=='__main__':
-    app1 = qg.QApplication(sys.argv)
-
-    transitionWidth = 12
-    transitionCenter = 71.1
-    materialToMeasure = 1
-
-    largestOnly = True # Only look at the largest component of each material
-    cleanup = False # Remove duplicate materials
-    display = False # Display output
+from dithering.indexing import removeDuplicateMaterials
 
-    # Open File
-    # file = 'stl_files_v4.2_combined/output_K'
-    file = 'stl_files_fdm_v1/output_J'
-    model = VoxelModel.openVF(file)
-    model.resolution = 5 # Manually set resolution if not set in file
+def contactArea(model, transitionWidth, transitionCenter, materialToMeasure, largestOnly=True):
+    # Returns the number of contact faces, the cropped model, and the isolated material of interest
     res = model.resolution
 
     # Define a region in which to calculate the contact area
@@ -43,11 +30,6 @@ if __name__=='__main__':
     testRegionLocation = (model.coords[0] + round(transitionCenter*res) - round(testRegionSize[0]*.5), model.coords[1], model.coords[2])
     test_region = cuboid(testRegionSize, testRegionLocation, material=3, resolution=res)
 
-    # Cleanup operations
-    if cleanup:
-        model.materials = np.round(model.materials, 3)
-        model = model.removeDuplicateMaterials()
-
     # Crop the model to the region of interest
     model_cropped = VoxelModel.emptyLike(model)
     if largestOnly:
@@ -117,6 +99,34 @@ if __name__=='__main__':
             if (model_cropped.voxels[x, y, z-1] != 0) and (model_cropped.voxels[x, y, z-1] != materialToMeasure):
                 totalSurfaceCount = totalSurfaceCount + 1
 
+    return totalSurfaceCount, model_cropped, model_single_material
+
+# Start Application
+if __name__=='__main__':
+    app1 = qg.QApplication(sys.argv)
+
+    transitionWidth = 12
+    transitionCenter = 71.1
+    materialToMeasure = 1
+
+    largestOnly = True # Only look at the largest component of each material
+    cleanup = False # Remove duplicate materials
+    display = False # Display output
+
+    # Open File
+    # file = 'stl_files_v4.2_combined/output_K'
+    file = 'stl_files_fdm_v1/output_J'
+    model = VoxelModel.openVF(file)
+    model.resolution = 5 # Manually set resolution if not set in file
+    res = model.resolution
+
+    # Cleanup operations
+    if cleanup:
+        model.materials = np.round(model.materials, 3)
+        model = removeDuplicateMaterials(model)
+
+    totalSurfaceCount, model_cropped, model_single_material = contactArea(model, transitionWidth, transitionCenter, materialToMeasure, largestOnly)
+
     print('\nNumber of contact surfaces: ' + str(totalSurfaceCount))
     print('Surface area: ' + str(totalSurfaceCount*(1/res)*(1/res)) + ' mm^2')
 
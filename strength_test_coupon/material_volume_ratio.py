@@ -14,6 +14,16 @@ from voxelfuse.primitives import *
 from voxelfuse.mesh import Mesh
 from voxelfuse.plot import Plot
 
+from dithering.indexing import removeDuplicateMaterials
+
+def volumeRatio(model, rigidMaterial, flexibleMaterial):
+    # Fraction of the model volume occupied by the rigid and flexible materials
+    _, totalVolume = model.getVolume()
+    _, rigidVolume = model.getVolume(material=rigidMaterial)
+    _, flexibleVolume = model.getVolume(material=flexibleMaterial)
+
+    return rigidVolume/totalVolume, flexibleVolume/totalVolume
+
 # Start Application
 if __name__=='__main__':
     app1 = qg.QApplication(sys.argv)
@@ -38,14 +48,9 @@ if __name__=='__main__':
         # Cleanup operations
         if cleanup:
             model.materials = np.round(model.materials, 3)
-            model = model.removeDuplicateMaterials()
-
-        _, totalVolume = model.getVolume()
-        _, rigidVolume = model.getVolume(material=rigidMaterial)
-        _, flexibleVolume = model.getVolume(material=flexibleMaterial)
+            model = removeDuplicateMaterials(model)
 
-        rigidPercentages[pattern] = rigidVolume/totalVolume
-        flexiblePercentages[pattern] = flexibleVolume/totalVolume
+        rigidPercentages[pattern], flexiblePercentages[pattern] = volumeRatio(model, rigidMaterial, flexibleMaterial)
 
     print('\nRigid: ' + str(rigidPercentages))
     print('Flexible: ' + str(flexiblePercentages))
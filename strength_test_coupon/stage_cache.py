@@ -0,0 +1,58 @@
+"""
+Copyright 2020
+Dan Aukes, Cole Brauer
+
+Cache of intermediate coupon models
+
+Each stage of strength_test_coupon_mm3dp_V2.py is stored under a hash of the config keys it uses,
+the key of the stage before it, and the input files it reads, so a re-run resumes from the first stage that changed
+Stored in the same format as the lattice element families, least recently used stages are removed first
+
+  python stage_cache.py        # list the cached stages
+  python stage_cache.py purge  # remove all cached stages
+"""
+
+import os
+import sys
+import time
+
+from lattice.families import fileHash, familyKey, familyHeader, loadFamily, saveFamily, cacheEntries, removeFamily
+from profiling.tracing import span
+
+STAGE_CACHE_FOLDER = os.environ.get('COUPON_STAGE_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stage_cache'))
+STAGE_CACHE_SIZE = 4 * 2 ** 30
+STAGE_VERSION = 7 # Increase when a stage changes its output for the same inputs
+
+def stageKey(stage, upstream, config, keys, files=(), defaults=None):
+    # upstream -- key of the previous stage, keys -- config keys used by this stage, files -- input files read by this stage
+    # defaults -- values the stage uses for keys missing from config, so a missing key and its default value share a key
+    defaults = defaults or {}
+    return familyKey(upstream, stage, STAGE_VERSION, [[k, config.get(k, defaults.get(k))] for k in keys], [fileHash(f) for f in files])
+
+def cachedStage(stage, key, build, enabled=True):
+    # build() returns the list of models produced by the stage
+    if not enabled:
+        return build()
+
+    with span('load cached ' + stage):
+        models = loadFamily(key, STAGE_CACHE_FOLDER, mmap=False)
+    if models is not None:
+        print('Using cached stage: ' + stage)
+        return models
+
+    models = build()
+    with span('cache ' + stage):
+        saveFamily(key, models, STAGE_CACHE_FOLDER, STAGE_CACHE_SIZE, info=stage)
+    return models
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'purge':
+        for key, _, _ in cacheEntries(STAGE_CACHE_FOLDER):
+            removeFamily(key, STAGE_CACHE_FOLDER)
+        print('Removed all stages from ' + STAGE_CACHE_FOLDER)
+    else:
+        entries = cacheEntries(STAGE_CACHE_FOLDER)
+        for key, size, used in entries:
+            header = familyHeader(key, STAGE_CACHE_FOLDER) or {}
+            print('%s %-12s %10.1f MB  last used %s' % (key, header.get('info'), size / 2 ** 20, time.strftime('%Y-%m-%d %H:%M', time.localtime(used))))
+        print('%d stages, %.1f MB of %.1f MB in %s' % (len(entries), sum(e[1] for e in entries) / 2 ** 20, STAGE_CACHE_SIZE / 2 ** 20, STAGE_CACHE_FOLDER))
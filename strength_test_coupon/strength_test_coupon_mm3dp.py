@@ -22,6 +22,7 @@ from voxelfuse.periodic import *
 from voxelfuse.voxel_model import Axes
 
 # from dithering.dither import dither
+from dithering.indexing import removeDuplicateMaterials
 
 configIDs = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K']
 
@@ -242,7 +243,7 @@ if __name__=='__main__':
             coupon = transition | coupon        # Add to result
 
         coupon = coupon.round(materialStep)
-        coupon = coupon.removeDuplicateMaterials()
+        coupon = removeDuplicateMaterials(coupon)
         coupon.resolution = res
 
         end = time.time()
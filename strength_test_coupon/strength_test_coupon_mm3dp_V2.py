@@ -10,9 +10,13 @@ import sys
 import time
 import math
 import yaml
+import multiprocessing
+import numba
+
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 import PyQt5.QtGui as qg
-from tqdm import tqdm
 
 from voxelfuse.voxel_model import VoxelModel
 from voxelfuse.mesh import Mesh
@@ -21,7 +25,15 @@ from voxelfuse.primitives import *
 from voxelfuse.periodic import *
 from voxelfuse.voxel_model import Axes
 
-# from dithering.dither import dither
+from dithering.blur import blurScaled
+from dithering.resample import downsampleModel, upsampleModel
+from dithering.dither import dither, localDensityError
+from dithering.indexing import removeDuplicateMaterials
+from lattice.families import dilationFamily, surfaceFamily
+from lattice.tiling import elementIndex, latticeDensity, tileLattice
+from lattice.tpms import gradedSurface
+from profiling.tracing import Tracer, span, activeTracer, merge
+from strength_test_coupon.stage_cache import stageKey, cachedStage
 
 configIDs = ['LA', 'LC', 'LD', 'LE', 'LF', 'LG', 'LH', 'LI', 'LJ', 'LK']
 # configIDs = ['LJ', 'LK']
@@ -31,236 +43,454 @@ configIDs = ['LA', 'LC', 'LD', 'LE', 'LF', 'LG', 'LH', 'LI', 'LJ', 'LK']
 display = False
 save = True
 export = False
+profile = False     # Save a stage-level trace for each config (JSON and Chrome trace format)
+traceMalloc = False # Include tracemalloc deltas in the trace, slows down pure Python stages
+parallelTransitions = True # Process the transition regions of a coupon in separate processes
+stageCache = True   # Reuse intermediate models from earlier runs when their inputs have not changed (see stage_cache.py)
 
 outputFolder = 'stl_files_fdm_v1'
 
-if __name__=='__main__':
-    for configID in configIDs:
-        # Load config
-        with open("config_files/config_" + configID + ".yaml", 'r') as f:
-            try:
-                config = yaml.safe_load(f)
-            except yaml.YAMLError as exc:
-                print(exc)
-
-        # Load settings
-        filename = config.get('filename')
-        res = config.get('res') # voxels per mm
-        couponStandard = config.get('couponStandard') # Start of stl file name
-        centerLengthScale = config.get('centerLengthScale') # transition length scale multiplier
-        blurRadius = config.get('blurRadius') # mm -- transition region width * 1/2
-        materialStep = config.get('materialStep')  # material step size of final result
-
-        blurEnable = config.get('blurEnable', False)
-        ditherEnable = config.get('ditherEnable', False)
-        latticeEnable = config.get('latticeEnable', False)
-        gyroidEnable = config.get('gyroidEnable', False)
-
-        if ditherEnable:
-            ditherType = config.get('ditherType')
-            processingRes = config.get('processingRes') # voxels per processed voxel
-
-        if latticeEnable:
-            latticeElementFile = config.get('latticeElementFile')
-            minRadius = config.get('minRadius')  # 0/1 min radius that results in a printable structure
-            maxRadius = config.get('maxRadius')  # 3/5 max radius that results in a viable lattice element
-
-        if gyroidEnable:
-            gyroidType = config.get('gyroidType')
-            gyroidScale = config.get('gyroidScale')
-            gyroidMaxDilate = config.get('gyroidMaxDilate')
-            gyroidMaxErode = config.get('gyroidMaxErode')
-
-        app1 = qg.QApplication(sys.argv)
-
-        # Import coupon components
-        print('Importing Files')
-        end1 = VoxelModel.fromMeshFile('coupon_templates/' + couponStandard + '-End.stl', (0, 0, 0), resolution=res).fitWorkspace()
-        center = VoxelModel.fromMeshFile('coupon_templates/' + couponStandard + '-Center-2.stl', (0, 0, 0), resolution=res).fitWorkspace()
-        end2 = end1.rotate90(2, axis=Axes.Z)
-        center.coords = (end1.voxels.shape[0], round((end1.voxels.shape[1] - center.voxels.shape[1]) / 2), 0)
-        end2.coords = (end1.voxels.shape[0] + center.voxels.shape[0], 0, 0)
-
-        # Trim center
-        center_cross_section = VoxelModel(center.voxels[0:2, :, :], 3).fitWorkspace()
-        centerLength = center.voxels.shape[0]
-        centerWidth = center_cross_section.voxels.shape[1]
-        centerHeight = center_cross_section.voxels.shape[2]
-
-        centerCoordsOffset = (
-        center.coords[0], center.coords[1] + round(((center.voxels.shape[1] - centerWidth) / 2)), center.coords[2])
-        center = cuboid((centerLength, centerWidth, centerHeight), centerCoordsOffset)
-
-        # Set materials
-        end1 = end1.setMaterial(1)
-        end2 = end2.setMaterial(1)
-        center = center.setMaterial(2)
-
-        # Combine components
-        coupon = end1 | center | end2
-        coupon = coupon.setMaterial(1)
-
-        # Remove end bumps
-        modelCutTool1 = cuboid((coupon.voxels.shape[0], coupon.voxels.shape[1], 12), (0, 0, coupon.voxels.shape[2] - 12), 3)
-        modelCutTool2 = cuboid((1, coupon.voxels.shape[1], coupon.voxels.shape[2]), (0, 0, 0), 3)
-        modelCutTool3 = cuboid((1, coupon.voxels.shape[1], coupon.voxels.shape[2]), (coupon.voxels.shape[0] - 1, 0, 0), 3)
-        coupon = coupon.difference(modelCutTool1 | modelCutTool2 | modelCutTool3)
-        coupon = coupon.fitWorkspace()
-        coupon.coords = (0,0,0)
-
-        # Scaled center
-        newCenterLength = round(centerLength * centerLengthScale)
-        centerCoordsOffset = (center.coords[0] + round((centerLength - newCenterLength) / 2), center.coords[1], center.coords[2])
-        center = cuboid((newCenterLength, centerWidth, centerHeight), centerCoordsOffset)
-        center = center.setMaterial(2)
-        coupon = center | coupon
-
-        coupon_input = VoxelModel.copy(coupon)
-
-        start = time.time()
-
-        # Generate transition regions
+# Values used for config keys that are missing from a config file, also used when hashing the stage keys
+CONFIG_DEFAULTS = {'blurEnable': False, 'ditherEnable': False, 'latticeEnable': False, 'gyroidEnable': False, 'gyroidImplicit': False,
+                   'ditherCompare': False, 'ditherStencil': 'lou_stucki', 'ditherParallel': False, 'ditherStreaming': False, 'transitionAxis': 0, 'gyroidScale': 1}
+
+def loadConfig(configID):
+    with open("config_files/config_" + configID + ".yaml", 'r') as f:
+        try:
+            config = yaml.safe_load(f)
+        except yaml.YAMLError as exc:
+            print(exc)
+    return config
+
+def voxelizeTemplates(couponStandard, res):
+    end1 = VoxelModel.fromMeshFile('coupon_templates/' + couponStandard + '-End.stl', (0, 0, 0), resolution=res).fitWorkspace()
+    center = VoxelModel.fromMeshFile('coupon_templates/' + couponStandard + '-Center-2.stl', (0, 0, 0), resolution=res).fitWorkspace()
+    return end1, center
+
+def importComponents(couponStandard, res, centerLengthScale, templates=None):
+    # Import coupon components
+    print('Importing Files')
+    if templates is None:
+        templates = voxelizeTemplates(couponStandard, res)
+    end1, center = templates
+    center = VoxelModel.copy(center) # Templates may be shared between configs
+    end2 = end1.rotate90(2, axis=Axes.Z)
+    center.coords = (end1.voxels.shape[0], round((end1.voxels.shape[1] - center.voxels.shape[1]) / 2), 0)
+    end2.coords = (end1.voxels.shape[0] + center.voxels.shape[0], 0, 0)
+
+    # Trim center
+    center_cross_section = VoxelModel(center.voxels[0:2, :, :], 3).fitWorkspace()
+    centerLength = center.voxels.shape[0]
+    centerWidth = center_cross_section.voxels.shape[1]
+    centerHeight = center_cross_section.voxels.shape[2]
+
+    centerCoordsOffset = (
+    center.coords[0], center.coords[1] + round(((center.voxels.shape[1] - centerWidth) / 2)), center.coords[2])
+    center = cuboid((centerLength, centerWidth, centerHeight), centerCoordsOffset)
+
+    # Set materials
+    end1 = end1.setMaterial(1)
+    end2 = end2.setMaterial(1)
+    center = center.setMaterial(2)
+
+    # Combine components
+    coupon = end1 | center | end2
+    coupon = coupon.setMaterial(1)
+
+    # Remove end bumps
+    modelCutTool1 = cuboid((coupon.voxels.shape[0], coupon.voxels.shape[1], 12), (0, 0, coupon.voxels.shape[2] - 12), 3)
+    modelCutTool2 = cuboid((1, coupon.voxels.shape[1], coupon.voxels.shape[2]), (0, 0, 0), 3)
+    modelCutTool3 = cuboid((1, coupon.voxels.shape[1], coupon.voxels.shape[2]), (coupon.voxels.shape[0] - 1, 0, 0), 3)
+    coupon = coupon.difference(modelCutTool1 | modelCutTool2 | modelCutTool3)
+    coupon = coupon.fitWorkspace()
+    coupon.coords = (0,0,0)
+
+    # Scaled center
+    newCenterLength = round(centerLength * centerLengthScale)
+    centerCoordsOffset = (center.coords[0] + round((centerLength - newCenterLength) / 2), center.coords[1], center.coords[2])
+    center = cuboid((newCenterLength, centerWidth, centerHeight), centerCoordsOffset)
+    center = center.setMaterial(2)
+    coupon = center | coupon
+
+    return coupon, center, newCenterLength
+
+def generateLatticeElements(config, center):
+    latticeSize = None
+    lattice_elements = None
+    if config.get('latticeEnable', CONFIG_DEFAULTS['latticeEnable']):
+        latticeElementFile = config.get('latticeElementFile')
+        minRadius = config.get('minRadius')  # 0/1 min radius that results in a printable structure
+        maxRadius = config.get('maxRadius')  # 3/5 max radius that results in a viable lattice element
+
+        # Import Models and Generate Dilated Lattice Elements
+        lattice_model = VoxelModel.fromVoxFile("lattice_elements/" + latticeElementFile + '.vox')
+        latticeSize = lattice_model.voxels.shape[0]
+        print('Lattice Element Imported')
+
+        lattice_elements = [VoxelModel.emptyLike(lattice_model)]
+        lattice_elements.extend(dilationFamily("lattice_elements/" + latticeElementFile + '.vox', minRadius, maxRadius, model=lattice_model))
+        lattice_elements.append(cuboid(lattice_model.voxels.shape))
+        print('Lattice Elements Generated')
+
+    elif config.get('gyroidEnable', CONFIG_DEFAULTS['gyroidEnable']):
+        gyroidType = config.get('gyroidType')
+        gyroidScale = config.get('gyroidScale', CONFIG_DEFAULTS['gyroidScale'])
+        gyroidMaxDilate = config.get('gyroidMaxDilate')
+        gyroidMaxErode = config.get('gyroidMaxErode')
+
+        s = center.voxels.shape[2] * gyroidScale
+        if config.get('gyroidImplicit', CONFIG_DEFAULTS['gyroidImplicit']):
+            # Surface is evaluated directly over the transition, no elements needed
+            return s, None
+
+        # Import Models and Generate Dilated Lattice Elements
+        lattice_model_1, family = surfaceFamily(gyroidType, s, gyroidMaxErode, gyroidMaxDilate)
+
+        latticeSize = s
+        print('Lattice Element Imported')
+
+        lattice_elements = [VoxelModel.emptyLike(lattice_model_1)]
+        lattice_elements.extend(family)
+        lattice_elements.append(cuboid(lattice_model_1.voxels.shape))
+        print('Lattice Elements Generated')
+
+    return latticeSize, lattice_elements
+
+def blurTransition(transition, transitionCenter, config):
+    res = config.get('res')
+    blurRadius = config.get('blurRadius')
+
+    transitionAxis = config.get('transitionAxis', CONFIG_DEFAULTS['transitionAxis']) # blurred in 1D along this axis when the transition only varies along it
+
+    print('Blurring')
+    with span('blur', axis=transitionAxis):
+        transition_scaled = blurScaled(transition, blurRadius*res, transitionAxis, exact=True)  # Apply blur and cleanup values
+    transition_scaled = transition_scaled.setCenter(transitionCenter)       # Center processed model on target region
+    return transition_scaled & transition                                   # Trim excess voxels
+
+def ditherTransition(transition, transitionCenter, config):
+    res = config.get('res')
+    blurRadius = config.get('blurRadius')
+    ditherType = config.get('ditherType')
+    processingRes = config.get('processingRes') # voxels per processed voxel
+    ditherCompare = config.get('ditherCompare', CONFIG_DEFAULTS['ditherCompare']) # compare ordered dither density error to error diffusion
+    ditherStencil = config.get('ditherStencil', CONFIG_DEFAULTS['ditherStencil']) # error diffusion stencil for ditherType 1
+    ditherParallel = config.get('ditherParallel', CONFIG_DEFAULTS['ditherParallel']) # wavefront error diffusion for ditherType 1, same result
+    ditherStreaming = config.get('ditherStreaming', CONFIG_DEFAULTS['ditherStreaming']) # error diffusion one z plane at a time, same result
+    transitionAxis = config.get('transitionAxis', CONFIG_DEFAULTS['transitionAxis'])
+
+    print('Dithering')
+    with span('blur', axis=transitionAxis):
+        transition_scaled = blurScaled(transition, blurRadius*res*1.5, transitionAxis, exact=True)
+    with span('downsample'):
+        transition_scaled = downsampleModel(transition_scaled, processingRes)    # Average blocks of voxels to the processing scale
+
+    with span('dither', ditherType=ditherType):
+        if ditherType == 2:
+            transition_scaled, _ = dither(transition_scaled, use_full=False, y_error=0.8, x_error=0.8, blur=False, streaming=ditherStreaming)   # Apply Dither
+        elif ditherType == 3:
+            transition_scaled, _ = dither(transition_scaled, use_full=False, y_error=0.8, blur=False, streaming=ditherStreaming)   # Apply Dither
+        elif ditherType == 4 or ditherType == 5:
+            thresholdMask = 'bayer' if ditherType == 4 else 'blue_noise'
+            transition_ordered, _ = dither(transition_scaled, blur=False, threshold_mask=thresholdMask)   # Apply Dither
+            if ditherCompare:
+                with span('ditherCompare'):
+                    transition_diffused, _ = dither(transition_scaled, blur=False)
+                    print('Local density error: ordered = %s, error diffusion = %s' % (localDensityError(transition_scaled, transition_ordered), localDensityError(transition_scaled, transition_diffused)))
+            transition_scaled = transition_ordered
+        else: # ditherType == 1
+            # The wavefront kernel only pays off with several numba threads (see transitionWorker)
+            parallel = ditherParallel and numba.get_num_threads() > 1
+            transition_scaled, _ = dither(transition_scaled, blur=False, stencil=ditherStencil, parallel=parallel, streaming=ditherStreaming)  # Apply Dither
+
+    with span('scaleValues'):
+        transition_scaled = transition_scaled.scaleValues()                                         # Cleanup values
+    with span('upsample'):
+        return upsampleModel(transition_scaled, processingRes, transition)                      # Increase to original scale inside the target region
+
+def latticeTransition(transition, transitionCenter, config, latticeSize, lattice_elements):
+    res = config.get('res')
+    blurRadius = config.get('blurRadius')
+    transitionAxis = config.get('transitionAxis', CONFIG_DEFAULTS['transitionAxis'])
+
+    print('Lattice')
+
+    boxX = math.ceil(transition.voxels.shape[0] / latticeSize)
+    boxY = math.ceil(transition.voxels.shape[1] / latticeSize)
+    boxZ = math.ceil(transition.voxels.shape[2] / latticeSize)
+    print([boxX, boxY, boxZ])
+
+    with span('lattice locations'):
+        lattice_locations = transition.scaleToSize((boxX, boxY, boxZ))
+        lattice_locations = blurScaled(lattice_locations, blurRadius*(res/latticeSize), transitionAxis, exact=True)
+        lattice_locations = lattice_locations - lattice_locations.setMaterial(2)
+        lattice_locations = lattice_locations.scaleNull()
+
+    # Convert processed model to lattice
+    element_index, histogram = elementIndex(lattice_locations, len(lattice_elements))
+    print('Element usage: ' + str(histogram))
+
+    with span('lattice fill', cells=boxX*boxY*boxZ, histogram=histogram.tolist()):
+        lattice_result = tileLattice(element_index[:boxX, :boxY, :boxZ], lattice_elements, latticeSize, material=1, resolution=lattice_locations.resolution, histogram=histogram)
+
+    lattice_result = lattice_result.setCenter(transitionCenter)   # Center processed model on target region
+    transition_scaled = lattice_result & transition               # Trim excess voxels
+    return transition_scaled | transition.setMaterial(2)
+
+def surfaceTransition(transition, config, period):
+    res = config.get('res')
+    blurRadius = config.get('blurRadius')
+    gyroidType = config.get('gyroidType')
+    transitionAxis = config.get('transitionAxis', CONFIG_DEFAULTS['transitionAxis'])
+
+    print('Graded Surface')
+
+    with span('lattice locations'):
+        lattice_locations = blurScaled(transition, blurRadius*res, transitionAxis, exact=True)
+        lattice_locations = lattice_locations - lattice_locations.setMaterial(2)
+        lattice_locations = lattice_locations.scaleNull()
+
+    # Threshold the surface function by the local density at full resolution
+    with span('surface fill', gyroidType=gyroidType, period=period):
+        voxels = gradedSurface(latticeDensity(lattice_locations), gyroidType, period, lattice_locations.coords)
+        lattice_result = VoxelModel(voxels, 1, lattice_locations.coords, lattice_locations.resolution)
+
+    transition_scaled = lattice_result & transition               # Trim excess voxels
+    return transition_scaled | transition.setMaterial(2)
+
+def processTransition(c, transition, transitionCenter, config, latticeSize, lattice_elements):
+    blurEnable = config.get('blurEnable', CONFIG_DEFAULTS['blurEnable'])
+    ditherEnable = config.get('ditherEnable', CONFIG_DEFAULTS['ditherEnable'])
+    latticeEnable = config.get('latticeEnable', CONFIG_DEFAULTS['latticeEnable'])
+    gyroidEnable = config.get('gyroidEnable', CONFIG_DEFAULTS['gyroidEnable'])
+    gyroidImplicit = config.get('gyroidImplicit', CONFIG_DEFAULTS['gyroidImplicit'])
+
+    print('Component #' + str(c+1))
+    print(transitionCenter)
+
+    if blurEnable: # Blur materials
+        transition = blurTransition(transition, transitionCenter, config)
+    elif ditherEnable: # Dither materials
+        transition = ditherTransition(transition, transitionCenter, config)
+    elif gyroidEnable and gyroidImplicit and not latticeEnable:
+        transition = surfaceTransition(transition, config, latticeSize)
+    elif latticeEnable or gyroidEnable:
+        transition = latticeTransition(transition, transitionCenter, config, latticeSize, lattice_elements)
+    return transition
+
+def transitionWorker(c, transition, transitionCenter, config, latticeSize, lattice_elements, trace_malloc, threads):
+    # Runs in a worker process, the trace of the worker is returned so it can be merged into the main trace
+    # trace_malloc -- tracemalloc setting of the main trace, None if the main process is not tracing
+    # threads -- numba threads for this worker, so the workers together do not use more threads than there are CPUs
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+    traced = trace_malloc is not None
+    tracer = Tracer('component ' + str(c+1), trace_malloc=trace_malloc) if traced else nullcontext()
+    with tracer:
+        with span('component', component=c+1):
+            transition = processTransition(c, transition, transitionCenter, config, latticeSize, lattice_elements)
+    return transition, tracer.toDict() if traced else None
+
+def workerContext():
+    # Forked workers reuse the functions numba has already compiled in this process
+    # Forking after the numba thread pool has started can hang at exit, so workers are started from a fork server in that case
+    # The fork server imports this module once and later pools fork their workers from it
+    methods = multiprocessing.get_all_start_methods()
+    try:
+        numba.threading_layer()
+        threadsStarted = True
+    except ValueError:
+        threadsStarted = False
+
+    if 'fork' in methods and not threadsStarted:
+        return multiprocessing.get_context('fork')
+    if 'forkserver' in methods:
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['__main__'] if __name__ == '__main__' else ['__main__', __name__])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+def processTransitions(transitions, config, latticeSize, lattice_elements):
+    # transitions -- list of (transition, transitionCenter), results are returned in the same order
+    workers = min(len(transitions), os.cpu_count() or 1)
+    if not parallelTransitions or workers < 2 or multiprocessing.current_process().daemon:
+        # Serial when there is nothing to gain, or when already running in a pool worker (e.g. batch_coupons.py)
+        results = []
+        for c, (transition, transitionCenter) in enumerate(transitions):
+            with span('component', component=c+1):
+                results.append(processTransition(c, transition, transitionCenter, config, latticeSize, lattice_elements))
+        return results
+
+    tracer = activeTracer()
+    trace_malloc = tracer.trace_malloc if tracer is not None else None
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(workers, mp_context=workerContext()) as executor:
+        futures = [executor.submit(transitionWorker, c, transition, transitionCenter, config, latticeSize, lattice_elements, trace_malloc, threads)
+                   for c, (transition, transitionCenter) in enumerate(transitions)]
+
+        results = []
+        for future in futures:
+            transition, trace = future.result()
+            merge(trace)
+            results.append(transition)
+    return results
+
+# Config keys used by each cached stage, see stage_cache.py
+COMPONENT_KEYS = ['centerLengthScale']
+TRANSITION_KEYS = ['blurRadius', 'blurEnable', 'ditherEnable', 'latticeEnable', 'gyroidEnable', 'transitionAxis',
+                   'ditherType', 'processingRes', 'ditherStencil',
+                   'latticeElementFile', 'minRadius', 'maxRadius',
+                   'gyroidType', 'gyroidScale', 'gyroidMaxDilate', 'gyroidMaxErode', 'gyroidImplicit']
+ROUND_KEYS = ['materialStep']
+
+def generateTransitions(coupon, center, newCenterLength, config):
+    res = config.get('res') # voxels per mm
+    blurRadius = config.get('blurRadius') # mm -- transition region width * 1/2
+
+    coupon_input = VoxelModel.copy(coupon)
+
+    # Generate transition regions
+    with span('transition regions'):
         transition_1 = cuboid((blurRadius * res * 2, coupon.voxels.shape[1], coupon.voxels.shape[2]), (center.coords[0] - (blurRadius * res), 0, 0), 3)
         transition_2 = cuboid((blurRadius * res * 2, coupon.voxels.shape[1], coupon.voxels.shape[2]), (center.coords[0] - (blurRadius * res) + newCenterLength, 0, 0), 3)
         transition_regions = transition_1 | transition_2
         transition_regions = transition_regions.getComponents()
 
-        # Generate lattice elements
-        latticeSize = None
-        lattice_elements = None
-        if latticeEnable:
-            # Import Models
-            lattice_model = VoxelModel.fromVoxFile("lattice_elements/" + latticeElementFile + '.vox')
-            latticeSize = lattice_model.voxels.shape[0]
-            print('Lattice Element Imported')
-
-            # Generate Dilated Lattice Elements
-            lattice_elements = [VoxelModel.emptyLike(lattice_model)]
-            for r in range(minRadius, maxRadius + 1):
-                lattice_elements.append(lattice_model.dilate(r))
-            lattice_elements.append(cuboid(lattice_model.voxels.shape))
-            print('Lattice Elements Generated')
-
-        elif gyroidEnable:
-            # Import Models
-            s = center.voxels.shape[2] * gyroidScale
-
-            if gyroidType == 2:
-                lattice_model_1, lattice_model_2 = schwarzP((s,s,s), s)
-            elif gyroidType == 3:
-                lattice_model_1, lattice_model_2 = schwarzD((s,s,s), s)
-            elif gyroidType == 4:
-                lattice_model_1, lattice_model_2 = FRD((s,s,s), s)
-            else: # gyroidType == 1
-                lattice_model_1, lattice_model_2 = gyroid((s,s,s), s)
-
-            latticeSize = s
-            print('Lattice Element Imported')
-
-            # Generate Dilated Lattice Elements
-            lattice_elements = [VoxelModel.emptyLike(lattice_model_1)]
-            for r in range(0, gyroidMaxErode):
-                lattice_elements.append(lattice_model_1.difference(lattice_model_2.dilate(gyroidMaxErode - r)))
-            for r in range(0, gyroidMaxDilate + 1):
-                lattice_elements.append(lattice_model_1.dilate(r))
-            lattice_elements.append(cuboid(lattice_model_1.voxels.shape))
-            print('Lattice Elements Generated')
-
-        # Generate transitions
-        for c in range(transition_regions.numComponents):
-            print('Component #' + str(c+1))
-            transition = coupon_input & (transition_regions.isolateComponent(c+1))
-            transitionCenter = transition.getCenter()
-            transition = transition.fitWorkspace()
-            print(transitionCenter)
-
-            if blurEnable: # Blur materials
-                print('Blurring')
-                transition_scaled = transition.blur(blurRadius*res)                 # Apply blur
-                transition_scaled = transition_scaled.scaleValues()                 # Cleanup values
-                transition_scaled = transition_scaled.setCenter(transitionCenter)   # Center processed model on target region
-                transition = transition_scaled & transition                         # Trim excess voxels
-
-            elif ditherEnable: # Dither materials
-                print('Dithering')
-                x_len = int(transition.voxels.shape[0])
-                y_len = int(transition.voxels.shape[1])
-                z_len = int(transition.voxels.shape[2])
-
-                transition_scaled = transition.blur(blurRadius*res*1.5)
-                transition_scaled = transition_scaled.scale((1 / processingRes))    # Reduce to processing scale and dilate to compensate for rounding errors
-
-                if ditherType == 2:
-                    transition_scaled = transition_scaled.dither(use_full=False, y_error=0.8, x_error=0.8)   # Apply Dither
-                elif ditherType == 3:
-                    transition_scaled = transition_scaled.dither(use_full=False, y_error=0.8)   # Apply Dither
-                else: # ditherType == 1
-                    transition_scaled = transition_scaled.dither()  # Apply Dither
-
-                transition_scaled = transition_scaled.scaleValues()                                         # Cleanup values
-                transition_scaled = transition_scaled.scaleToSize((x_len, y_len, z_len))                      # Increase to original scale
-                transition_scaled = transition_scaled.setCenter(transitionCenter)                           # Center processed model on target region
-                transition = transition_scaled & transition                                                 # Trim excess voxels
-
-            elif latticeEnable or gyroidEnable:
-                print('Lattice')
-
-                boxX = math.ceil(transition.voxels.shape[0] / latticeSize)
-                boxY = math.ceil(transition.voxels.shape[1] / latticeSize)
-                boxZ = math.ceil(transition.voxels.shape[2] / latticeSize)
-                print([boxX, boxY, boxZ])
-
-                lattice_locations = transition.scaleToSize((boxX, boxY, boxZ))
-                lattice_locations = lattice_locations.blur(blurRadius*(res/latticeSize))
-                lattice_locations = lattice_locations.scaleValues()
-                lattice_locations = lattice_locations - lattice_locations.setMaterial(2)
-                lattice_locations = lattice_locations.scaleNull()
-
-                # Convert processed model to lattice
-                lattice_result = VoxelModel.emptyLike(lattice_locations)
-
-                for x in tqdm(range(boxX), desc='Adding lattice elements'):
-                    for y in range(boxY):
-                        for z in range(boxZ):
-                            i = lattice_locations.voxels[x, y, z]
-                            density = lattice_locations.materials[i, 0] * (1 - lattice_locations.materials[i, 1])
-
-                            if density < 1e-10:
-                                r = 0
-                            elif density > (1 - 1e-10):
-                                r = len(lattice_elements) - 1
-                            else:
-                                r = round(density * (len(lattice_elements) - 3)) + 1
-
-                            r = int(r)
-
-                            locationOffset = round((lattice_elements[r].voxels.shape[0] - latticeSize) / 2)
-
-                            x2 = (x * latticeSize) - locationOffset
-                            y2 = (y * latticeSize) - locationOffset
-                            z2 = (z * latticeSize) - locationOffset
-
-                            lattice_elements[r].coords = (x2, y2, z2) # Do not use setCoords here
-
-                            lattice_result = lattice_result.union(lattice_elements[r])
-
-                lattice_result = lattice_result.setMaterial(1)
-                lattice_result = lattice_result.setCenter(transitionCenter)   # Center processed model on target region
-                transition_scaled = lattice_result & transition               # Trim excess voxels
-                transition = transition_scaled | transition.setMaterial(2)
+    # Generate lattice elements
+    with span('lattice elements'):
+        latticeSize, lattice_elements = generateLatticeElements(config, center)
+
+    # Isolate transitions
+    transitions = []
+    for c in range(transition_regions.numComponents):
+        transition = coupon_input & (transition_regions.isolateComponent(c+1))
+        transitionCenter = transition.getCenter()
+        transitions.append((transition.fitWorkspace(), transitionCenter))
+
+    # Generate transitions, each component only depends on coupon_input
+    with span('transitions', components=len(transitions)):
+        transitions = processTransitions(transitions, config, latticeSize, lattice_elements)
 
+    # Merge in component order
+    with span('merge'):
+        for transition in transitions:
             transition = transition & coupon    # Trim excess voxels
             coupon = transition | coupon        # Add to result
 
-        coupon = coupon.round(materialStep)
-        coupon = coupon.removeDuplicateMaterials()
-        coupon.resolution = res
+    return coupon
+
+def generateCoupon(config, templates=None):
+    # templates -- optional dict of (couponStandard, res): voxelized templates from voxelizeTemplates
+    # Each stage is loaded from the stage cache if its inputs have not changed (when stageCache is enabled)
+    res = config.get('res') # voxels per mm
+    couponStandard = config.get('couponStandard') # Start of stl file name
+    centerLengthScale = config.get('centerLengthScale') # transition length scale multiplier
+    materialStep = config.get('materialStep')  # material step size of final result
+
+    templateFiles = ['coupon_templates/' + couponStandard + '-End.stl', 'coupon_templates/' + couponStandard + '-Center-2.stl']
+    templateKey = stageKey('templates', None, config, ['couponStandard', 'res'], templateFiles, defaults=CONFIG_DEFAULTS)
+    shared = (templates or {}).get((couponStandard, res))
+
+    with span('voxelize templates', couponStandard=couponStandard, res=res):
+        if shared is None:
+            shared = cachedStage('templates', templateKey, lambda: list(voxelizeTemplates(couponStandard, res)), stageCache)
+
+    componentKey = stageKey('components', templateKey, config, COMPONENT_KEYS, defaults=CONFIG_DEFAULTS)
+    with span('components'):
+        coupon, center = cachedStage('components', componentKey, lambda: list(importComponents(couponStandard, res, centerLengthScale, shared)[:2]), stageCache)
+        newCenterLength = center.voxels.shape[0]
+
+    start = time.time()
+
+    transitionFiles = ['lattice_elements/' + config.get('latticeElementFile') + '.vox'] if config.get('latticeEnable', CONFIG_DEFAULTS['latticeEnable']) else []
+    transitionKey = stageKey('transitions', componentKey, config, TRANSITION_KEYS, transitionFiles, defaults=CONFIG_DEFAULTS)
+    coupon, = cachedStage('transitions', transitionKey, lambda: [generateTransitions(coupon, center, newCenterLength, config)], stageCache)
+
+    roundKey = stageKey('round', transitionKey, config, ROUND_KEYS, defaults=CONFIG_DEFAULTS)
+    def roundMaterials():
+        with span('round materials'):
+            result = coupon.round(materialStep)
+            result = removeDuplicateMaterials(result)
+            result.resolution = res
+        return [result]
+    coupon, = cachedStage('round', roundKey, roundMaterials, stageCache)
+
+    end = time.time()
+    processingTime = (end - start)
+    print("Processing time = %s" % processingTime)
+
+    return coupon
+
+def saveCoupon(coupon, filename):
+    try:
+        os.mkdir(outputFolder)
+    except OSError:
+        print('Output folder already exists')
+    else:
+        print('Output folder successfully created')
+
+    print('Saving')
+    coupon.saveVF(outputFolder + '/output_' + filename)
+
+def exportCoupon(coupon, filename, couponStandard, res):
+    print('Exporting')
+
+    try:
+        os.mkdir(outputFolder + '/stl_output_' + filename)
+    except OSError:
+        print('Output folder already exists')
+    else:
+        print('Output folder successfully created')
+
+    for m in range(1, len(coupon.materials)):
+        current_mesh = Mesh.fromVoxelModel(coupon.isolateMaterial(m), resolution=res)
+        current_mesh.export((outputFolder + '/stl_output_' + filename +'/' + couponStandard + '_mat_' + str(m) + '_' + str(coupon.materials[m, 2]) + '.stl'))
+
+def runConfig(configID, templates=None):
+    # Generate, save and export the coupon for one config
+    # Returns the config, the coupon, and the processing time
+    tracer = Tracer(configID, trace_malloc=traceMalloc) if profile else nullcontext()
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+
+    with tracer:
+        # Load config
+        with span('load config'):
+            config = loadConfig(configID)
+
+        filename = config.get('filename')
+        res = config.get('res')
+        couponStandard = config.get('couponStandard')
+
+        coupon = generateCoupon(config, templates)
+
+        if save:
+            with span('save'):
+                saveCoupon(coupon, filename)
+
+        if export:
+            with span('export'):
+                exportCoupon(coupon, filename, couponStandard, res)
+
+    timing = {'wall': time.perf_counter() - wallStart, 'cpu': time.process_time() - cpuStart}
+
+    if profile:
+        os.makedirs(outputFolder, exist_ok=True)
+        tracer.summary()
+        tracer.save(outputFolder + '/profile_' + filename + '.json')
+        tracer.saveChromeTrace(outputFolder + '/profile_' + filename + '_chrome.json')
+
+    return config, coupon, timing
 
-        end = time.time()
-        processingTime = (end - start)
-        print("Processing time = %s" % processingTime)
+if __name__=='__main__':
+    app1 = qg.QApplication(sys.argv) if display else None
+
+    for configID in configIDs:
+        config, coupon, _ = runConfig(configID)
 
         if display:
+            filename = config.get('filename')
+            res = config.get('res')
+
             # Create mesh data
             print('Meshing')
             mesh1 = Mesh.fromVoxelModel(coupon, resolution=res)
@@ -272,29 +502,4 @@ if __name__=='__main__':
             app1.processEvents()
             app1.exec_()
 
-        if save:
-            try:
-                os.mkdir(outputFolder)
-            except OSError:
-                print('Output folder already exists')
-            else:
-                print('Output folder successfully created')
-
-            print('Saving')
-            coupon.saveVF(outputFolder + '/output_' + filename)
-
-        if export:
-            print('Exporting')
-
-            try:
-                os.mkdir(outputFolder + '/stl_output_' + filename)
-            except OSError:
-                print('Output folder already exists')
-            else:
-                print('Output folder successfully created')
-
-            for m in range(1, len(coupon.materials)):
-                current_mesh = Mesh.fromVoxelModel(coupon.isolateMaterial(m), resolution=res)
-                current_mesh.export((outputFolder + '/stl_output_' + filename +'/' + couponStandard + '_mat_' + str(m) + '_' + str(coupon.materials[m, 2]) + '.stl'))
-
-    print('Finished')
\ No newline at end of file
+    print('Finished')